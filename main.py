@@ -1,24 +1,40 @@
 from yolo.detect_fashion_items import detect_fashion_items
 from sam.segment_objects import segment_objects
+from streaming_pipeline import run_streaming_pipeline
 
 # 定義處理類型
 process_type = "w_preprocess"  # 可以改成 "w_preprocess"
 
-# 執行 YOLO 物件偵測
-detect_fashion_items(
-    input_path=f"become_image/{process_type}",
-    output_json_path=f"sam_data_{process_type}.json",
-    conflict_rules_path="yolo/yolo_conflict_rules.json",
-    show_image=False,
-    save_image=True,
-    output_image_dir=f"output_image/yolo/{process_type}",
-    min_confidence=0.05,
-)
+# 是否使用串流模式（YOLO 偵測與 SAM 分割同時進行，不必等整個資料夾偵測完）
+use_streaming = False
 
-# 執行 SAM 分割
-segment_objects(
-    input_json_path=f"sam_data_{process_type}.json",
-    input_image_dir=f"become_image/{process_type}",
-    output_base_dir=f"output_image/sam/{process_type}",
-    sam_checkpoint="sam_vit_h_4b8939.pth"
-)
\ No newline at end of file
+if use_streaming:
+    run_streaming_pipeline(
+        input_path=f"become_image/{process_type}",
+        output_base_dir=f"output_image/sam/{process_type}",
+        sam_checkpoint="sam_vit_h_4b8939.pth",
+        conflict_rules_path="yolo/yolo_conflict_rules.json",
+        min_confidence=0.05,
+        output_json_path=f"sam_data_{process_type}.json",
+        save_image=True,
+        output_image_dir=f"output_image/yolo/{process_type}",
+    )
+else:
+    # 執行 YOLO 物件偵測
+    detect_fashion_items(
+        input_path=f"become_image/{process_type}",
+        output_json_path=f"sam_data_{process_type}.json",
+        conflict_rules_path="yolo/yolo_conflict_rules.json",
+        show_image=False,
+        save_image=True,
+        output_image_dir=f"output_image/yolo/{process_type}",
+        min_confidence=0.05,
+    )
+
+    # 執行 SAM 分割
+    segment_objects(
+        input_json_path=f"sam_data_{process_type}.json",
+        input_image_dir=f"become_image/{process_type}",
+        output_base_dir=f"output_image/sam/{process_type}",
+        sam_checkpoint="sam_vit_h_4b8939.pth"
+    )
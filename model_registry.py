@@ -0,0 +1,77 @@
+import os
+import threading
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers import AutoImageProcessor, AutoModelForObjectDetection
+
+from segment_anything import SamPredictor, sam_model_registry
+
+YOLOS_MODEL_NAME = "valentinafeve/yolos-fashionpedia"
+
+# 整個 process 共用的模型快取：key 為 (模型名稱, checkpoint 路徑, device)
+_models = {}
+_lock = threading.Lock()
+
+
+def get_yolos(model_name=YOLOS_MODEL_NAME, device="cpu", warmup=False):
+    """
+    取得 YOLOS 的 (processor, model)。同一個 process 內相同 (model_name, device)
+    只會載入一次，之後的呼叫直接重用。warmup=True 時，第一次載入後會先跑一次假資料。
+    """
+    key = ("yolos", model_name, str(device))
+
+    def load():
+        processor = AutoImageProcessor.from_pretrained(model_name)
+        model = AutoModelForObjectDetection.from_pretrained(model_name).to(device).eval()
+        if warmup:
+            warmup_yolos(processor, model)
+        return processor, model
+
+    return _get_or_load(key, load)
+
+
+def get_sam(model_type="vit_h", checkpoint="sam_vit_h_4b8939.pth", device="cpu", warmup=False):
+    """
+    取得 SAM 模型。同一個 process 內相同 (model_type, checkpoint, device)
+    只會建立一次，之後的呼叫直接重用。warmup=True 時，第一次載入後會先跑一次假資料。
+    """
+    checkpoint_key = os.path.abspath(checkpoint) if checkpoint is not None else None
+    key = ("sam", model_type, checkpoint_key, str(device))
+
+    def load():
+        sam = sam_model_registry[model_type](checkpoint=checkpoint).to(device)
+        if warmup:
+            warmup_sam(sam)
+        return sam
+
+    return _get_or_load(key, load)
+
+
+def warmup_yolos(processor, model):
+    """用一張空白圖片跑一次 YOLOS forward，讓第一張真正的圖片不必負擔初始化成本。"""
+    image = Image.new("RGB", (800, 800))
+    inputs = processor(images=image, return_tensors="pt").to(model.device)
+    with torch.no_grad():
+        model(**inputs)
+
+
+def warmup_sam(sam):
+    """用一張空白圖片跑一次 SAM 的 image encoder 與 box 解碼。"""
+    predictor = SamPredictor(sam)
+    predictor.set_image(np.zeros((sam.image_encoder.img_size, sam.image_encoder.img_size, 3), dtype=np.uint8))
+    predictor.predict(box=np.array([0, 0, 16, 16]), multimask_output=False)
+
+
+def clear_models():
+    """釋放所有快取的模型。"""
+    with _lock:
+        _models.clear()
+
+
+def _get_or_load(key, load):
+    with _lock:
+        if key not in _models:
+            _models[key] = load()
+        return _models[key]
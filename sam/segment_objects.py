@@ -3,13 +3,18 @@ import os
 import numpy as np
 import cv2
 from collections import defaultdict
-from segment_anything import SamPredictor, sam_model_registry
+from model_registry import get_sam
+from segment_anything import SamPredictor
+from segment_anything.utils.embedding_cache import ImageEmbeddingCache
 
 def segment_objects(
     input_json_path,
     input_image_dir,
     output_base_dir,
-    sam_checkpoint="sam_vit_h_4b8939.pth"
+    sam_checkpoint="sam_vit_h_4b8939.pth",
+    embedding_cache_dir=None,
+    embedding_cache_max_bytes=2 * 1024**3,
+    encode_batch_size=4,
 ):
 
     print(f"📄 從檔案載入資料：{input_json_path}")
@@ -20,8 +25,17 @@ def segment_objects(
 
     # === 初始化 SAM 模型 ===
     print("🧠 載入 SAM 模型中...")
-    sam = sam_model_registry["vit_h"](checkpoint=sam_checkpoint)
-    predictor = SamPredictor(sam)
+    sam = get_sam("vit_h", sam_checkpoint)
+    embedding_cache = None
+    if embedding_cache_dir is not None:
+        embedding_cache = ImageEmbeddingCache(
+            embedding_cache_dir,
+            model_type="vit_h",
+            checkpoint=sam_checkpoint,
+            max_size_bytes=embedding_cache_max_bytes,
+        )
+        print(f"💾 使用 embedding 快取：{embedding_cache_dir}（已有 {len(embedding_cache)} 筆）")
+    predictor = SamPredictor(sam, embedding_cache=embedding_cache)
     print("✅ SAM 模型初始化完成")
 
     # === 建立主輸出資料夾 ===
@@ -38,75 +52,119 @@ def segment_objects(
     # 儲存處理結果
     results = {}
 
-    # === 開始處理每張圖片 ===
-    for image_idx, (filename, detections) in enumerate(grouped_data.items(), start=1):
-        print(f"🔄 [{image_idx}/{len(grouped_data)}] 處理圖片：{filename}，共 {len(detections)} 個物件")
+    # === 每次讀取 encode_batch_size 張圖片，一次送進 image encoder ===
+    grouped_items = list(grouped_data.items())
+    for start in range(0, len(grouped_items), encode_batch_size):
+        loaded = []
+        for image_idx, (filename, detections) in enumerate(
+            grouped_items[start : start + encode_batch_size], start=start + 1
+        ):
+            print(f"🔄 [{image_idx}/{len(grouped_data)}] 讀取圖片：{filename}，共 {len(detections)} 個物件")
+
+            image_path = os.path.join(input_image_dir, filename)
+            if not os.path.exists(image_path):
+                print(f"❌ 找不到圖片：{image_path}，跳過")
+                continue
 
-        image_path = os.path.join(input_image_dir, filename)
-        if not os.path.exists(image_path):
-            print(f"❌ 找不到圖片：{image_path}，跳過")
-            continue
+            image = cv2.imread(image_path)
+            if image is None:
+                print(f"❌ 圖片讀取失敗：{image_path}，跳過")
+                continue
 
-        image = cv2.imread(image_path)
-        if image is None:
-            print(f"❌ 圖片讀取失敗：{image_path}，跳過")
-            continue
+            image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            loaded.append((filename, detections, image, image_rgb))
 
-        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        predictor.set_image(image_rgb)
-        print("   🧠 已設定圖片給 SAM Predictor")
-
-        # 建立子資料夾
-        base_name = os.path.splitext(filename)[0]
-        sub_output_dir = os.path.join(output_base_dir, f"seg_{base_name}")
-        os.makedirs(sub_output_dir, exist_ok=True)
-        print(f"   📁 建立子資料夾：{sub_output_dir}")
-
-        # 儲存原圖到子資料夾
-        original_img_output_path = os.path.join(sub_output_dir, filename)
-        cv2.imwrite(original_img_output_path, image)
-        print(f"   🖼️ 已儲存原圖：{original_img_output_path}")
-
-        # 初始化此圖片的結果字典
-        results[filename] = {}
-        used_labels = set()
-
-        for i, item in enumerate(detections):
-            label = item["label"]
-            if label in used_labels:
-                print(f"      ⚠️ label {label} 已處理過，跳過")
-                continue
-            used_labels.add(label)
+        if not loaded:
+            continue
 
-            box = np.array(item["box"])
-            box_input = box[None, :]  # (1, 4)
+        embeddings = predictor.encode_batch(
+            [image_rgb for _, _, _, image_rgb in loaded], batch_size=encode_batch_size
+        )
+        print(f"🧠 已批次計算 {len(loaded)} 張圖片的 embedding\n")
 
-            print(f"   🎯 [{i+1}/{len(detections)}] 處理 label: {label}，box: {box.tolist()}")
+        for (filename, detections, image, image_rgb), embedding in zip(loaded, embeddings):
+            print(f"🔄 處理圖片：{filename}")
+            predictor.set_image_embedding(embedding)
+            results[filename] = _segment_image(
+                predictor, filename, detections, image, image_rgb, output_base_dir
+            )
 
-            # SAM 預測遮罩
-            masks, _, _ = predictor.predict(box=box_input, multimask_output=False)
-            mask = masks[0]
+    print("🎉 全部圖片處理完畢！所有切割圖與原圖已輸出到：", output_base_dir)
+    return results
 
-            # 建立遮罩區塊
-            mask_3c = np.stack([mask] * 3, axis=-1)
-            cutout = image_rgb * mask_3c
 
-            # 裁切區域
-            x0, y0, x1, y1 = box.astype(int)
-            cropped = cutout[y0:y1, x0:x1]
+def _segment_image(predictor, filename, detections, image, image_rgb, output_base_dir):
+    """對已設定 embedding 的圖片批次預測所有 box，並儲存裁切結果。"""
+    prompts, boxes, masks, regions = predict_box_masks(predictor, detections, image_rgb)
+    return save_cutouts(
+        filename, detections, image, image_rgb, prompts, boxes, masks, regions, output_base_dir
+    )
 
-            # 儲存圖片
-            save_path = os.path.join(sub_output_dir, f"{label}.png")
-            cropped_bgr = cv2.cvtColor(cropped, cv2.COLOR_RGB2BGR)
-            success = cv2.imwrite(save_path, cropped_bgr)
 
-            if success:
-                print(f"      ✅ 已儲存：{save_path}")
-                results[filename][label] = save_path
-            else:
-                print(f"      ❌ 儲存失敗：{save_path}")
+def predict_box_masks(predictor, detections, image_rgb):
+    """去除重複 label 後，把所有 box 一次送進 SAM，回傳 (prompts, boxes, masks, regions)。"""
+    used_labels = set()
 
+    # 去除重複 label，保留第一次出現的 box
+    prompts = []
+    for i, item in enumerate(detections):
+        label = item["label"]
+        if label in used_labels:
+            print(f"      ⚠️ label {label} 已處理過，跳過")
+            continue
+        used_labels.add(label)
+        prompts.append((i, item))
+
+    if not prompts:
+        return prompts, None, None, None
+
+    # SAM 批次預測遮罩：所有 box 一次送進 prompt encoder / mask decoder，
+    # 遮罩只在 box 範圍內放大到原圖解析度，不產生整張圖大小的遮罩
+    boxes = np.array([item["box"] for _, item in prompts])
+    masks, _, regions = predictor.predict_box_crops(boxes, multimask_output=False)
+    masks = [mask[0] for mask in masks]  # 每個 (h, w)，對應 regions 中的範圍
+    print(f"   🧠 已批次預測 {len(prompts)} 個遮罩")
+    return prompts, boxes, masks, regions
+
+
+def save_cutouts(filename, detections, image, image_rgb, prompts, boxes, masks, regions, output_base_dir):
+    """儲存原圖與每個 label 的裁切圖，回傳 {label: 儲存路徑}。"""
+    # 建立子資料夾
+    base_name = os.path.splitext(filename)[0]
+    sub_output_dir = os.path.join(output_base_dir, f"seg_{base_name}")
+    os.makedirs(sub_output_dir, exist_ok=True)
+    print(f"   📁 建立子資料夾：{sub_output_dir}")
+
+    # 儲存原圖到子資料夾
+    original_img_output_path = os.path.join(sub_output_dir, filename)
+    cv2.imwrite(original_img_output_path, image)
+    print(f"   🖼️ 已儲存原圖：{original_img_output_path}")
+
+    # 初始化此圖片的結果字典
+    results = {}
+    if not prompts:
         print(f"   ✅ 圖片 {filename} 處理完成\n")
-
-    print("🎉 全部圖片處理完畢！所有切割圖與原圖已輸出到：", output_base_dir)
-    return results
\ No newline at end of file
+        return results
+
+    for (i, item), box, mask, region in zip(prompts, boxes, masks, regions):
+        label = item["label"]
+        print(f"   🎯 [{i+1}/{len(detections)}] 處理 label: {label}，box: {box.tolist()}")
+
+        # 裁切區域後再套用遮罩（遮罩只涵蓋 region，需換算成相對座標）
+        x0, y0, x1, y1 = box.astype(int)
+        rx0, ry0 = region[:2]
+        cropped = image_rgb[y0:y1, x0:x1] * mask[y0 - ry0 : y1 - ry0, x0 - rx0 : x1 - rx0, None]
+
+        # 儲存圖片
+        save_path = os.path.join(sub_output_dir, f"{label}.png")
+        cropped_bgr = cv2.cvtColor(cropped, cv2.COLOR_RGB2BGR)
+        success = cv2.imwrite(save_path, cropped_bgr)
+
+        if success:
+            print(f"      ✅ 已儲存：{save_path}")
+            results[label] = save_path
+        else:
+            print(f"      ❌ 儲存失敗：{save_path}")
+
+    print(f"   ✅ 圖片 {filename} 處理完成\n")
+    return results
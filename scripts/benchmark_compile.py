@@ -0,0 +1,143 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from typing import List, Tuple
+
+from segment_anything import SamPredictor, sam_model_registry
+
+parser = argparse.ArgumentParser(
+    description=(
+        "Measures how many images it takes for Sam.compile_for_inference to pay for its "
+        "compilation time on CPU. Runs eager, compiled with an empty inductor cache, and "
+        "compiled again with that cache (a warm restart), each in a fresh process, and "
+        "reports per-image encode and decode times and the break-even image count."
+    )
+)
+
+parser.add_argument(
+    "--model-type",
+    type=str,
+    default="vit_b",
+    help="The type of model to benchmark, in ['default', 'vit_h', 'vit_l', 'vit_b'].",
+)
+
+parser.add_argument(
+    "--checkpoint",
+    type=str,
+    default=None,
+    help="The path to the SAM checkpoint. If not given, random weights are used.",
+)
+
+parser.add_argument(
+    "--num-images",
+    type=int,
+    default=3,
+    help="The number of images each run encodes and decodes a box prompt for.",
+)
+
+parser.add_argument(
+    "--image-size",
+    type=int,
+    nargs=2,
+    default=[1200, 900],
+    help="The height and width of the random test images.",
+)
+
+parser.add_argument(
+    "--worker",
+    type=str,
+    choices=["eager", "compiled"],
+    default=None,
+    help=argparse.SUPPRESS,
+)
+
+
+def run_worker(args: argparse.Namespace) -> List[Tuple[float, float]]:
+    """Times set_image and a box prediction for each image in this process."""
+    torch.manual_seed(0)
+    sam = sam_model_registry[args.model_type](
+        checkpoint=args.checkpoint, compile=args.worker == "compiled"
+    )
+    predictor = SamPredictor(sam)
+    rng = np.random.RandomState(0)
+    h, w = args.image_size
+    box = np.array([w // 8, h // 6, w * 3 // 4, h * 5 // 6])
+    times = []
+    for _ in range(args.num_images):
+        image = (rng.rand(h, w, 3) * 255).astype(np.uint8)
+        start = time.perf_counter()
+        predictor.set_image(image)
+        encoded = time.perf_counter()
+        predictor.predict(box=box, multimask_output=False)
+        times.append((encoded - start, time.perf_counter() - encoded))
+    return times
+
+
+def run(args: argparse.Namespace, mode: str, cache_dir: str) -> List[Tuple[float, float]]:
+    command = [sys.executable, os.path.abspath(__file__), "--worker", mode]
+    command += ["--model-type", args.model_type, "--num-images", str(args.num_images)]
+    command += ["--image-size", *map(str, args.image_size)]
+    if args.checkpoint is not None:
+        command += ["--checkpoint", args.checkpoint]
+    env = dict(os.environ, TORCHINDUCTOR_CACHE_DIR=cache_dir)
+    output = subprocess.run(command, env=env, check=True, capture_output=True, text=True)
+    return json.loads(output.stdout.splitlines()[-1])
+
+
+def main(args: argparse.Namespace) -> None:
+    cache_dir = tempfile.mkdtemp(prefix="sam_inductor_")
+    try:
+        runs = {"eager": run(args, "eager", cache_dir)}
+        runs["compiled, cold cache"] = run(args, "compiled", cache_dir)
+        runs["compiled, warm cache"] = run(args, "compiled", cache_dir)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    print(f"{'run':<22} {'image':>5} {'encode (s)':>11} {'decode (s)':>11}")
+    for name, times in runs.items():
+        for i, (encode, decode) in enumerate(times):
+            print(f"{name:<22} {i:>5} {encode:>11.2f} {decode:>11.3f}")
+
+    # Steady-state time per image, from all images after the first
+    def steady(times: List[Tuple[float, float]]) -> float:
+        rest = times[1:] or times
+        return float(np.mean([encode + decode for encode, decode in rest]))
+
+    eager = steady(runs["eager"])
+    compiled = steady(runs["compiled, cold cache"])
+    print(f"\nsteady state per image: eager {eager:.2f} s, compiled {compiled:.2f} s")
+    if args.num_images < 2:
+        print("Use --num-images 2 or more to separate compilation from steady-state time.")
+    for name in ["compiled, cold cache", "compiled, warm cache"]:
+        first_overhead = sum(runs[name][0]) - sum(runs["eager"][0])
+        if compiled >= eager:
+            print(f"{name}: compiled is not faster per image, compilation never pays off")
+        else:
+            break_even = max(first_overhead, 0.0) / (eager - compiled) + 1
+            print(
+                f"{name}: first image {first_overhead:+.1f} s against eager, "
+                f"pays off after {break_even:.1f} images"
+            )
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.worker is not None:
+        print(json.dumps(run_worker(args)))
+    else:
+        main(args)
@@ -0,0 +1,118 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import time
+
+import torch
+
+from typing import Any, Dict, List
+
+from segment_anything.utils.amg import mask_to_rle_pytorch
+
+parser = argparse.ArgumentParser(
+    description=(
+        "Times mask_to_rle_pytorch against the previous per-mask encoding loop "
+        "on batches of random disc masks, and checks that both give equal output."
+    )
+)
+
+parser.add_argument(
+    "--num-masks",
+    type=int,
+    nargs="+",
+    default=[64, 256, 1000],
+    help="The batch sizes to time.",
+)
+
+parser.add_argument(
+    "--size",
+    type=int,
+    default=1500,
+    help="The height and width of each mask.",
+)
+
+parser.add_argument(
+    "--repeats",
+    type=int,
+    default=3,
+    help="The number of runs per case. The fastest one is reported.",
+)
+
+parser.add_argument(
+    "--device",
+    type=str,
+    default="cpu",
+    help="The device to run on.",
+)
+
+
+def mask_to_rle_pytorch_loop(tensor: torch.Tensor) -> List[Dict[str, Any]]:
+    """The previous implementation, which filters and transfers once per mask."""
+    b, h, w = tensor.shape
+    tensor = tensor.permute(0, 2, 1).flatten(1)
+
+    diff = tensor[:, 1:] ^ tensor[:, :-1]
+    change_indices = diff.nonzero()
+
+    out = []
+    for i in range(b):
+        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
+        cur_idxs = torch.cat(
+            [
+                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
+                cur_idxs + 1,
+                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
+            ]
+        )
+        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
+        counts = [] if tensor[i, 0] == 0 else [0]
+        counts.extend(btw_idxs.detach().cpu().tolist())
+        out.append({"size": [h, w], "counts": counts})
+    return out
+
+
+def random_masks(num_masks: int, size: int, device: str) -> torch.Tensor:
+    generator = torch.Generator().manual_seed(0)
+    centers = torch.rand(num_masks, 2, generator=generator) * size
+    radii = torch.rand(num_masks, generator=generator) * size / 4 + 1
+    coords = torch.arange(size, dtype=torch.float32)
+    masks = torch.empty(num_masks, size, size, dtype=torch.bool)
+    for i in range(num_masks):
+        dy = (coords - centers[i, 0])[:, None] ** 2
+        dx = (coords - centers[i, 1])[None, :] ** 2
+        masks[i] = dy + dx < radii[i] ** 2
+    return masks.to(device)
+
+
+def time_fn(fn, masks: torch.Tensor, repeats: int, device: str):
+    best, out = float("inf"), None
+    for _ in range(repeats):
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        out = fn(masks)
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main(args: argparse.Namespace) -> None:
+    print(f"{'masks':>6} {'size':>11} {'loop (s)':>9} {'vectorized (s)':>15} {'speedup':>8}")
+    for num_masks in args.num_masks:
+        masks = random_masks(num_masks, args.size, args.device)
+        loop_time, expected = time_fn(mask_to_rle_pytorch_loop, masks, args.repeats, args.device)
+        new_time, out = time_fn(mask_to_rle_pytorch, masks, args.repeats, args.device)
+        assert out == expected, f"Outputs differ for {num_masks} masks."
+        print(
+            f"{num_masks:>6} {args.size:>5}x{args.size:<5} {loop_time:>9.3f} "
+            f"{new_time:>15.3f} {loop_time / new_time:>7.2f}x"
+        )
+        del masks, expected, out
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -8,13 +8,15 @@ import numpy as np
 import torch
 from torchvision.ops.boxes import batched_nms, box_area  # type: ignore
 
-from typing import Any, Dict, List, Optional, Tuple
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple, Union
 
 from .modeling import Sam
-from .predictor import SamPredictor
+from .predictor import ImageEmbedding, SamPredictor
 from .utils.amg import (
     MaskData,
-    area_from_rle,
+    RleArray,
     batch_iterator,
     batched_mask_to_box,
     box_xyxy_to_xywh,
@@ -26,6 +28,7 @@ from .utils.amg import (
     mask_to_rle_pytorch,
     remove_small_regions,
     rle_to_mask,
+    rles_to_masks,
     uncrop_boxes_xyxy,
     uncrop_masks,
     uncrop_points,
@@ -49,6 +52,10 @@ class SamAutomaticMaskGenerator:
         point_grids: Optional[List[np.ndarray]] = None,
         min_mask_region_area: int = 0,
         output_mode: str = "binary_mask",
+        postprocess_num_workers: int = 1,
+        crop_batch_size: int = 1,
+        overlap_crop_encoding: bool = False,
+        skip_covered_points: bool = False,
     ) -> None:
         """
         Using a SAM model, generates masks for the entire image.
@@ -93,6 +100,20 @@ class SamAutomaticMaskGenerator:
             'uncompressed_rle', or 'coco_rle'. 'coco_rle' requires pycocotools.
             For large resolutions, 'binary_mask' may consume large amounts of
             memory.
+          postprocess_num_workers (int): The number of threads used to remove
+            small regions and holes when min_mask_region_area > 0.
+          crop_batch_size (int): The number of image crops run through the
+            image encoder together. Higher numbers may be faster but use more
+            GPU memory.
+          overlap_crop_encoding (bool): If true and there is more than one
+            batch of crops, the next batch is encoded on a background thread
+            while the masks of the current one are decoded. This helps when
+            the two can run in parallel, e.g. with the encoder on a GPU, but
+            holds the embeddings of two batches at once.
+          skip_covered_points (bool): If true, points are not run through the
+            model if they fall inside a mask accepted from an earlier batch of
+            the same crop. Much faster on images with a few large regions, at
+            the cost of missing smaller masks nested inside them.
         """
 
         assert (points_per_side is None) != (
@@ -132,6 +153,10 @@ class SamAutomaticMaskGenerator:
         self.crop_n_points_downscale_factor = crop_n_points_downscale_factor
         self.min_mask_region_area = min_mask_region_area
         self.output_mode = output_mode
+        self.postprocess_num_workers = postprocess_num_workers
+        self.crop_batch_size = crop_batch_size
+        self.overlap_crop_encoding = overlap_crop_encoding
+        self.skip_covered_points = skip_covered_points
 
     @torch.no_grad()
     def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
@@ -158,6 +183,32 @@ class SamAutomaticMaskGenerator:
                crop_box (list(float)): The crop of the image used to generate
                  the mask, given in XYWH format.
         """
+        return list(self.iter_generate(image))
+
+    @torch.no_grad()
+    def iter_generate(
+        self, image: np.ndarray, output_mode: Optional[str] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Generates masks for the given image, yielding the records one at a
+        time. Masks are kept run-length encoded until their record is
+        yielded, so with output_mode='binary_mask' only the mask being
+        consumed is held at full resolution, unless the caller keeps them.
+
+        Arguments:
+          image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+          output_mode (str or None): Overrides the generator's output_mode
+            for this call.
+
+        Returns:
+          (iterator(dict(str, any))): Records in the format returned by 'generate'.
+        """
+        output_mode = output_mode or self.output_mode
+        assert output_mode in [
+            "binary_mask",
+            "uncompressed_rle",
+            "coco_rle",
+        ], f"Unknown output_mode {output_mode}."
 
         # Generate masks
         mask_data = self._generate_masks(image)
@@ -168,31 +219,52 @@ class SamAutomaticMaskGenerator:
                 mask_data,
                 self.min_mask_region_area,
                 max(self.box_nms_thresh, self.crop_nms_thresh),
+                self.postprocess_num_workers,
             )
 
-        # Encode masks
-        if self.output_mode == "coco_rle":
-            mask_data["segmentations"] = [coco_encode_rle(rle) for rle in mask_data["rles"]]
-        elif self.output_mode == "binary_mask":
-            mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
-        else:
-            mask_data["segmentations"] = mask_data["rles"]
-
-        # Write mask records
-        curr_anns = []
-        for idx in range(len(mask_data["segmentations"])):
-            ann = {
-                "segmentation": mask_data["segmentations"][idx],
-                "area": area_from_rle(mask_data["rles"][idx]),
+        # Encode each mask as its record is requested
+        areas = mask_data["rles"].areas()
+        for idx in range(len(mask_data["rles"])):
+            rle = mask_data["rles"][idx]
+            if output_mode == "coco_rle":
+                segmentation = coco_encode_rle(rle)
+            elif output_mode == "binary_mask":
+                segmentation = rle_to_mask(rle)
+            else:
+                segmentation = rle
+            yield {
+                "segmentation": segmentation,
+                "area": int(areas[idx]),
                 "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
                 "predicted_iou": mask_data["iou_preds"][idx].item(),
                 "point_coords": [mask_data["points"][idx].tolist()],
                 "stability_score": mask_data["stability_score"][idx].item(),
                 "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"][idx]).tolist(),
             }
-            curr_anns.append(ann)
 
-        return curr_anns
+    def generate_to_jsonl(self, image: np.ndarray, output: Union[str, TextIO]) -> int:
+        """
+        Generates masks for the given image and writes their records as JSON
+        lines, one record per line with the segmentation in COCO RLE format,
+        without holding all records in memory. Requires pycocotools.
+
+        Arguments:
+          image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+          output (str or file): The path of the file to write, or an open
+            text file to append the lines to.
+
+        Returns:
+          (int): The number of records written.
+        """
+        if isinstance(output, str):
+            with open(output, "w") as f:
+                return self.generate_to_jsonl(image, f)
+
+        num_records = 0
+        for record in self.iter_generate(image, output_mode="coco_rle"):
+            output.write(json.dumps(record) + "\n")
+            num_records += 1
+        return num_records
 
     def _generate_masks(self, image: np.ndarray) -> MaskData:
         orig_size = image.shape[:2]
@@ -200,11 +272,16 @@ class SamAutomaticMaskGenerator:
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
         )
 
-        # Iterate over image crops
+        # Encode the crops in batches of crop_batch_size
+        crops = list(zip(crop_boxes, layer_idxs))
+        chunks = [
+            crops[i : i + self.crop_batch_size] for i in range(0, len(crops), self.crop_batch_size)
+        ]
         data = MaskData()
-        for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
-            data.cat(crop_data)
+        for chunk, embeddings in self._iter_crop_embeddings(image, chunks):
+            for (crop_box, layer_idx), embedding in zip(chunk, embeddings):
+                crop_data = self._process_crop(crop_box, layer_idx, orig_size, embedding)
+                data.cat(crop_data)
 
         # Remove duplicate masks between crops
         if len(crop_boxes) > 1:
@@ -222,18 +299,42 @@ class SamAutomaticMaskGenerator:
         data.to_numpy()
         return data
 
+    def _iter_crop_embeddings(
+        self, image: np.ndarray, chunks: List[List[Tuple[List[int], int]]]
+    ) -> Iterator[Tuple[List[Tuple[List[int], int]], List[ImageEmbedding]]]:
+        if not self.overlap_crop_encoding or len(chunks) == 1:
+            for chunk in chunks:
+                yield chunk, self._encode_crops(image, chunk)
+            return
+
+        # Encode the next batch on a background thread while the caller
+        # decodes the current one
+        with ThreadPoolExecutor(1) as executor:
+            next_embeddings = executor.submit(self._encode_crops, image, chunks[0])
+            for chunk_idx, chunk in enumerate(chunks):
+                embeddings = next_embeddings.result()
+                if chunk_idx + 1 < len(chunks):
+                    next_embeddings = executor.submit(
+                        self._encode_crops, image, chunks[chunk_idx + 1]
+                    )
+                yield chunk, embeddings
+
+    def _encode_crops(
+        self, image: np.ndarray, crops: List[Tuple[List[int], int]]
+    ) -> List[ImageEmbedding]:
+        cropped_ims = [image[y0:y1, x0:x1, :] for (x0, y0, x1, y1), _ in crops]
+        return self.predictor.encode_batch(cropped_ims, batch_size=self.crop_batch_size)
+
     def _process_crop(
         self,
-        image: np.ndarray,
         crop_box: List[int],
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
+        embedding: ImageEmbedding,
     ) -> MaskData:
-        # Crop the image and calculate embeddings
-        x0, y0, x1, y1 = crop_box
-        cropped_im = image[y0:y1, x0:x1, :]
-        cropped_im_size = cropped_im.shape[:2]
-        self.predictor.set_image(cropped_im)
+        # Use the precomputed embeddings of the crop
+        cropped_im_size = embedding.original_size
+        self.predictor.set_image_embedding(embedding)
 
         # Get points for this crop
         points_scale = np.array(cropped_im_size)[None, ::-1]
@@ -241,10 +342,29 @@ class SamAutomaticMaskGenerator:
 
         # Generate masks for this crop in batches
         data = MaskData()
-        for (points,) in batch_iterator(self.points_per_batch, points_for_image):
-            batch_data = self._process_batch(points, cropped_im_size, crop_box, orig_size)
-            data.cat(batch_data)
-            del batch_data
+        if not self.skip_covered_points:
+            for (points,) in batch_iterator(self.points_per_batch, points_for_image):
+                batch_data = self._process_batch(points, cropped_im_size, crop_box, orig_size)
+                data.cat(batch_data)
+                del batch_data
+        else:
+            # Before each batch, drop the points that already lie inside a mask
+            # accepted from an earlier batch
+            covered = torch.zeros(cropped_im_size, dtype=torch.bool, device=self.predictor.device)
+            points_left = points_for_image
+            while len(points_left) > 0:
+                pixels = np.minimum(points_left.astype(int), np.array(cropped_im_size)[::-1] - 1)
+                is_covered = covered[pixels[:, 1], pixels[:, 0]].cpu().numpy()
+                points_left = points_left[~is_covered]
+                points = points_left[: self.points_per_batch]
+                points_left = points_left[self.points_per_batch :]
+                if len(points) == 0:
+                    break
+                batch_data = self._process_batch(
+                    points, cropped_im_size, crop_box, orig_size, covered
+                )
+                data.cat(batch_data)
+                del batch_data
         self.predictor.reset_image()
 
         # Remove duplicates within this crop.
@@ -269,6 +389,7 @@ class SamAutomaticMaskGenerator:
         im_size: Tuple[int, ...],
         crop_box: List[int],
         orig_size: Tuple[int, ...],
+        covered: Optional[torch.Tensor] = None,
     ) -> MaskData:
         orig_h, orig_w = orig_size
 
@@ -313,20 +434,26 @@ class SamAutomaticMaskGenerator:
         if not torch.all(keep_mask):
             data.filter(keep_mask)
 
+        # Record the area covered by the accepted masks, in the crop frame
+        if covered is not None and len(data["masks"]) > 0:
+            covered |= data["masks"].any(dim=0)
+
         # Compress to RLE
         data["masks"] = uncrop_masks(data["masks"], crop_box, orig_h, orig_w)
-        data["rles"] = mask_to_rle_pytorch(data["masks"])
+        data["rles"] = RleArray.from_masks(data["masks"])
         del data["masks"]
 
         return data
 
     @staticmethod
     def postprocess_small_regions(
-        mask_data: MaskData, min_area: int, nms_thresh: float
+        mask_data: MaskData, min_area: int, nms_thresh: float, num_workers: int = 1
     ) -> MaskData:
         """
         Removes small disconnected regions and holes in masks, then reruns
-        box NMS to remove any new duplicates.
+        box NMS to remove any new duplicates. Masks are processed by a pool
+        of num_workers threads, since OpenCV releases the GIL; the result
+        does not depend on the number of workers.
 
         Edits mask_data in place.
 
@@ -335,24 +462,31 @@ class SamAutomaticMaskGenerator:
         if len(mask_data["rles"]) == 0:
             return mask_data
 
-        # Filter small disconnected regions and holes
-        new_masks = []
-        scores = []
-        for rle in mask_data["rles"]:
-            mask = rle_to_mask(rle)
+        # Filter small disconnected regions and holes, writing the results
+        # back into the buffer the masks were decoded to
+        masks_np = rles_to_masks(mask_data["rles"])
+        scores = [0.0] * len(masks_np)
 
-            mask, changed = remove_small_regions(mask, min_area, mode="holes")
+        def process(i: int) -> None:
+            mask, changed = remove_small_regions(masks_np[i], min_area, mode="holes")
             unchanged = not changed
             mask, changed = remove_small_regions(mask, min_area, mode="islands")
             unchanged = unchanged and not changed
 
-            new_masks.append(torch.as_tensor(mask).unsqueeze(0))
+            masks_np[i] = mask
             # Give score=0 to changed masks and score=1 to unchanged masks
             # so NMS will prefer ones that didn't need postprocessing
-            scores.append(float(unchanged))
+            scores[i] = float(unchanged)
+
+        if num_workers > 1:
+            with ThreadPoolExecutor(num_workers) as executor:
+                list(executor.map(process, range(len(masks_np))))
+        else:
+            for i in range(len(masks_np)):
+                process(i)
 
         # Recalculate boxes and remove any new duplicates
-        masks = torch.cat(new_masks, dim=0)
+        masks = torch.from_numpy(masks_np)
         boxes = batched_mask_to_box(masks)
         keep_by_nms = batched_nms(
             boxes.float(),
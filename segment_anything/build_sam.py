@@ -6,41 +6,54 @@
 
 import torch
 
+from contextlib import nullcontext
 from functools import partial
 
 from .modeling import ImageEncoderViT, MaskDecoder, PromptEncoder, Sam, TwoWayTransformer
 
 
-def build_sam_vit_h(checkpoint=None):
+def build_sam_vit_h(checkpoint=None, dtype=None, decoder_dtype=None, quantize=None, compile=False):
     return _build_sam(
         encoder_embed_dim=1280,
         encoder_depth=32,
         encoder_num_heads=16,
         encoder_global_attn_indexes=[7, 15, 23, 31],
         checkpoint=checkpoint,
+        dtype=dtype,
+        decoder_dtype=decoder_dtype,
+        quantize=quantize,
+        compile=compile,
     )
 
 
 build_sam = build_sam_vit_h
 
 
-def build_sam_vit_l(checkpoint=None):
+def build_sam_vit_l(checkpoint=None, dtype=None, decoder_dtype=None, quantize=None, compile=False):
     return _build_sam(
         encoder_embed_dim=1024,
         encoder_depth=24,
         encoder_num_heads=16,
         encoder_global_attn_indexes=[5, 11, 17, 23],
         checkpoint=checkpoint,
+        dtype=dtype,
+        decoder_dtype=decoder_dtype,
+        quantize=quantize,
+        compile=compile,
     )
 
 
-def build_sam_vit_b(checkpoint=None):
+def build_sam_vit_b(checkpoint=None, dtype=None, decoder_dtype=None, quantize=None, compile=False):
     return _build_sam(
         encoder_embed_dim=768,
         encoder_depth=12,
         encoder_num_heads=12,
         encoder_global_attn_indexes=[2, 5, 8, 11],
         checkpoint=checkpoint,
+        dtype=dtype,
+        decoder_dtype=decoder_dtype,
+        quantize=quantize,
+        compile=compile,
     )
 
 
@@ -58,50 +71,103 @@ def _build_sam(
     encoder_num_heads,
     encoder_global_attn_indexes,
     checkpoint=None,
+    dtype=None,
+    decoder_dtype=None,
+    quantize=None,
+    compile=False,
 ):
+    if quantize not in (None, "int8"):
+        raise ValueError(f"Unsupported quantization {quantize}, expected None or 'int8'.")
+    if quantize is not None and (dtype is not None or decoder_dtype is not None):
+        raise ValueError("quantize cannot be combined with dtype or decoder_dtype.")
     prompt_embed_dim = 256
     image_size = 1024
     vit_patch_size = 16
     image_embedding_size = image_size // vit_patch_size
-    sam = Sam(
-        image_encoder=ImageEncoderViT(
-            depth=encoder_depth,
-            embed_dim=encoder_embed_dim,
-            img_size=image_size,
-            mlp_ratio=4,
-            norm_layer=partial(torch.nn.LayerNorm, eps=1e-6),
-            num_heads=encoder_num_heads,
-            patch_size=vit_patch_size,
-            qkv_bias=True,
-            use_rel_pos=True,
-            global_attn_indexes=encoder_global_attn_indexes,
-            window_size=14,
-            out_chans=prompt_embed_dim,
-        ),
-        prompt_encoder=PromptEncoder(
-            embed_dim=prompt_embed_dim,
-            image_embedding_size=(image_embedding_size, image_embedding_size),
-            input_image_size=(image_size, image_size),
-            mask_in_chans=16,
-        ),
-        mask_decoder=MaskDecoder(
-            num_multimask_outputs=3,
-            transformer=TwoWayTransformer(
-                depth=2,
-                embedding_dim=prompt_embed_dim,
-                mlp_dim=2048,
-                num_heads=8,
+    pixel_mean = [123.675, 116.28, 103.53]
+    pixel_std = [58.395, 57.12, 57.375]
+    # When weights come from a checkpoint, build the modules on the meta device
+    # to skip allocating and randomly initializing weights that are overwritten.
+    with torch.device("meta") if checkpoint is not None else nullcontext():
+        sam = Sam(
+            image_encoder=ImageEncoderViT(
+                depth=encoder_depth,
+                embed_dim=encoder_embed_dim,
+                img_size=image_size,
+                mlp_ratio=4,
+                norm_layer=partial(torch.nn.LayerNorm, eps=1e-6),
+                num_heads=encoder_num_heads,
+                patch_size=vit_patch_size,
+                qkv_bias=True,
+                use_rel_pos=True,
+                global_attn_indexes=encoder_global_attn_indexes,
+                window_size=14,
+                out_chans=prompt_embed_dim,
             ),
-            transformer_dim=prompt_embed_dim,
-            iou_head_depth=3,
-            iou_head_hidden_dim=256,
-        ),
-        pixel_mean=[123.675, 116.28, 103.53],
-        pixel_std=[58.395, 57.12, 57.375],
-    )
+            prompt_encoder=PromptEncoder(
+                embed_dim=prompt_embed_dim,
+                image_embedding_size=(image_embedding_size, image_embedding_size),
+                input_image_size=(image_size, image_size),
+                mask_in_chans=16,
+            ),
+            mask_decoder=MaskDecoder(
+                num_multimask_outputs=3,
+                transformer=TwoWayTransformer(
+                    depth=2,
+                    embedding_dim=prompt_embed_dim,
+                    mlp_dim=2048,
+                    num_heads=8,
+                ),
+                transformer_dim=prompt_embed_dim,
+                iou_head_depth=3,
+                iou_head_hidden_dim=256,
+            ),
+            pixel_mean=pixel_mean,
+            pixel_std=pixel_std,
+        )
     sam.eval()
     if checkpoint is not None:
-        with open(checkpoint, "rb") as f:
-            state_dict = torch.load(f)
-        sam.load_state_dict(state_dict)
+        # Memory-map the checkpoint and adopt its tensors as the parameters, so
+        # peak memory stays at roughly one copy of the weights.
+        state_dict = torch.load(checkpoint, map_location="cpu", mmap=True, weights_only=True)
+        if _is_quantized_state_dict(state_dict):
+            if quantize != "int8":
+                raise ValueError(f"{checkpoint} holds int8 weights, build with quantize='int8'.")
+            # Quantized weights can only be loaded into an already quantized
+            # model, so quantize placeholder weights first and overwrite them.
+            sam.to_empty(device="cpu")
+            with torch.no_grad():
+                for param in sam.parameters():
+                    param.zero_()
+            _quantize_sam(sam)
+            sam.load_state_dict(state_dict)
+        else:
+            sam.load_state_dict(state_dict, assign=True)
+        # Non-persistent buffers are not stored in the checkpoint.
+        sam.register_buffer("pixel_mean", torch.Tensor(pixel_mean).view(-1, 1, 1), False)
+        sam.register_buffer("pixel_std", torch.Tensor(pixel_std).view(-1, 1, 1), False)
+    if dtype is not None or decoder_dtype is not None:
+        sam.set_inference_dtype(dtype or torch.float32, decoder_dtype or torch.float32)
+    if quantize == "int8" and not _is_quantized_state_dict(sam.state_dict()):
+        _quantize_sam(sam)
+    if compile:
+        sam.compile_for_inference()
     return sam
+
+
+def _quantize_sam(sam):
+    """
+    Applies dynamic int8 quantization to the linear layers of the image
+    encoder and mask decoder, in place. Weights are stored in int8 and
+    activations are quantized on the fly, which suits CPU inference. The
+    state_dict of the result can be saved with torch.save and loaded back
+    by building with quantize='int8' and that file as the checkpoint.
+    """
+    for module in (sam.image_encoder, sam.mask_decoder):
+        torch.ao.quantization.quantize_dynamic(
+            module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+
+
+def _is_quantized_state_dict(state_dict):
+    return any(k.endswith("_packed_params._packed_params") for k in state_dict)
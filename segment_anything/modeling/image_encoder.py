@@ -54,6 +54,7 @@ class ImageEncoderViT(nn.Module):
         """
         super().__init__()
         self.img_size = img_size
+        self.embed_size = img_size // patch_size
 
         self.patch_embed = PatchEmbed(
             kernel_size=(patch_size, patch_size),
@@ -104,14 +105,21 @@ class ImageEncoderViT(nn.Module):
         )
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # Inputs smaller than img_size, such as an image padded only to a
+        # multiple of the patch size, are encoded on their own token grid,
+        # using the top-left part of the position embedding. Their image
+        # embeddings are zero-padded to the full embedding size.
         x = self.patch_embed(x)
+        h, w = x.shape[1], x.shape[2]
         if self.pos_embed is not None:
-            x = x + self.pos_embed
+            x = x + self.pos_embed[:, :h, :w, :]
 
         for blk in self.blocks:
             x = blk(x)
 
         x = self.neck(x.permute(0, 3, 1, 2))
+        if h < self.embed_size or w < self.embed_size:
+            x = F.pad(x, (0, self.embed_size - w, 0, self.embed_size - h))
 
         return x
 
@@ -206,6 +214,8 @@ class Attention(nn.Module):
         """
         super().__init__()
         self.num_heads = num_heads
+        # Upper bound on the relative position bias elements materialized per head.
+        self.max_bias_elements = 1 << 22
         head_dim = dim // num_heads
         self.scale = head_dim**-0.5
 
@@ -228,13 +238,36 @@ class Attention(nn.Module):
         # q, k, v with shape (B * nHead, H * W, C)
         q, k, v = qkv.reshape(3, B * self.num_heads, H * W, -1).unbind(0)
 
-        attn = (q * self.scale) @ k.transpose(-2, -1)
-
-        if self.use_rel_pos:
-            attn = add_decomposed_rel_pos(attn, q, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W))
+        if not self.use_rel_pos:
+            x = F.scaled_dot_product_attention(q, k, v, scale=self.scale)
+        else:
+            # On a token grid smaller than input_size, only the embeddings of
+            # the relative distances that occur on it are used
+            rel_pos_h = _crop_rel_pos(self.rel_pos_h, H)
+            rel_pos_w = _crop_rel_pos(self.rel_pos_w, W)
+            rel_h, rel_w = get_decomposed_rel_pos(q, rel_pos_h, rel_pos_w, (H, W), (H, W))
+            # The relative position bias is passed to the fused kernel as an
+            # additive mask. Query rows are processed in chunks so that the
+            # mask never holds more than max_bias_elements per head, instead
+            # of the full (H * W) x (H * W) map in the global attention blocks.
+            rows = max(1, min(H, self.max_bias_elements // (W * H * W)))
+            x = torch.cat(
+                [
+                    F.scaled_dot_product_attention(
+                        q[:, r * W : (r + rows) * W],
+                        k,
+                        v,
+                        attn_mask=(
+                            rel_h[:, r : r + rows, :, :, None] + rel_w[:, r : r + rows, :, None, :]
+                        ).reshape(B * self.num_heads, -1, H * W),
+                        scale=self.scale,
+                    )
+                    for r in range(0, H, rows)
+                ],
+                dim=1,
+            )
 
-        attn = attn.softmax(dim=-1)
-        x = (attn @ v).view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+        x = x.view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
         x = self.proj(x)
 
         return x
@@ -289,6 +322,17 @@ def window_unpartition(
     return x
 
 
+def _crop_rel_pos(rel_pos: torch.Tensor, size: int) -> torch.Tensor:
+    """
+    Returns the entries of the relative position embeddings (L, C) for the
+    relative distances -(size - 1) to size - 1, if L covers more than those.
+    """
+    center = (rel_pos.shape[0] - 1) // 2
+    if center <= size - 1:
+        return rel_pos
+    return rel_pos[center - (size - 1) : center + size]
+
+
 def get_rel_pos(q_size: int, k_size: int, rel_pos: torch.Tensor) -> torch.Tensor:
     """
     Get relative positional embeddings according to the relative positions of
@@ -322,19 +366,16 @@ def get_rel_pos(q_size: int, k_size: int, rel_pos: torch.Tensor) -> torch.Tensor
     return rel_pos_resized[relative_coords.long()]
 
 
-def add_decomposed_rel_pos(
-    attn: torch.Tensor,
+def get_decomposed_rel_pos(
     q: torch.Tensor,
     rel_pos_h: torch.Tensor,
     rel_pos_w: torch.Tensor,
     q_size: Tuple[int, int],
     k_size: Tuple[int, int],
-) -> torch.Tensor:
+) -> Tuple[torch.Tensor, torch.Tensor]:
     """
-    Calculate decomposed Relative Positional Embeddings from :paper:`mvitv2`.
-    https://github.com/facebookresearch/mvit/blob/19786631e330df9f3622e5402b4a419a263a2c80/mvit/models/attention.py   # noqa B950
+    Calculate the height and width terms of decomposed Relative Positional Embeddings.
     Args:
-        attn (Tensor): attention map.
         q (Tensor): query q in the attention layer with shape (B, q_h * q_w, C).
         rel_pos_h (Tensor): relative position embeddings (Lh, C) for height axis.
         rel_pos_w (Tensor): relative position embeddings (Lw, C) for width axis.
@@ -342,7 +383,8 @@ def add_decomposed_rel_pos(
         k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
 
     Returns:
-        attn (Tensor): attention map with added relative positional embeddings.
+        rel_h (Tensor): height term with shape (B, q_h, q_w, k_h).
+        rel_w (Tensor): width term with shape (B, q_h, q_w, k_w).
     """
     q_h, q_w = q_size
     k_h, k_w = k_size
@@ -353,7 +395,36 @@ def add_decomposed_rel_pos(
     r_q = q.reshape(B, q_h, q_w, dim)
     rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
     rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
+    return rel_h, rel_w
+
+
+def add_decomposed_rel_pos(
+    attn: torch.Tensor,
+    q: torch.Tensor,
+    rel_pos_h: torch.Tensor,
+    rel_pos_w: torch.Tensor,
+    q_size: Tuple[int, int],
+    k_size: Tuple[int, int],
+) -> torch.Tensor:
+    """
+    Calculate decomposed Relative Positional Embeddings from :paper:`mvitv2`.
+    https://github.com/facebookresearch/mvit/blob/19786631e330df9f3622e5402b4a419a263a2c80/mvit/models/attention.py   # noqa B950
+    Args:
+        attn (Tensor): attention map.
+        q (Tensor): query q in the attention layer with shape (B, q_h * q_w, C).
+        rel_pos_h (Tensor): relative position embeddings (Lh, C) for height axis.
+        rel_pos_w (Tensor): relative position embeddings (Lw, C) for width axis.
+        q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
+        k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
+
+    Returns:
+        attn (Tensor): attention map with added relative positional embeddings.
+    """
+    q_h, q_w = q_size
+    k_h, k_w = k_size
+    rel_h, rel_w = get_decomposed_rel_pos(q, rel_pos_h, rel_pos_w, q_size, k_size)
 
+    B = q.shape[0]
     attn = (
         attn.view(B, q_h, q_w, k_h, k_w) + rel_h[:, :, :, :, None] + rel_w[:, :, :, None, :]
     ).view(B, q_h * q_w, k_h * k_w)
@@ -8,7 +8,8 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
-from typing import Any, Dict, List, Tuple
+import warnings
+from typing import Any, Dict, List, Optional, Tuple
 
 from .image_encoder import ImageEncoderViT
 from .mask_decoder import MaskDecoder
@@ -50,6 +51,66 @@ class Sam(nn.Module):
     def device(self) -> Any:
         return self.pixel_mean.device
 
+    @property
+    def encoder_dtype(self) -> torch.dtype:
+        return self.image_encoder.patch_embed.proj.weight.dtype
+
+    @property
+    def decoder_dtype(self) -> torch.dtype:
+        return self.mask_decoder.iou_token.weight.dtype
+
+    @property
+    def encoder_quantized(self) -> bool:
+        return any(
+            isinstance(m, torch.ao.nn.quantized.dynamic.Linear)
+            for m in self.image_encoder.modules()
+        )
+
+    def set_inference_dtype(
+        self,
+        encoder_dtype: torch.dtype,
+        decoder_dtype: torch.dtype = torch.float32,
+    ) -> None:
+        """
+        Sets the precision the image encoder and the mask decoder run in,
+        e.g. torch.bfloat16 on CPU or torch.float16 on GPU. Pixel
+        normalization, the prompt encoder and mask postprocessing always
+        run in float32, and inputs and outputs are cast at the boundaries.
+
+        Arguments:
+          encoder_dtype (torch.dtype): The dtype of the image encoder.
+          decoder_dtype (torch.dtype): The dtype of the mask decoder.
+        """
+        self.image_encoder.to(encoder_dtype)
+        self.mask_decoder.to(decoder_dtype)
+
+    def compile_for_inference(self) -> None:
+        """
+        Compiles the image encoder and the mask decoder with torch.compile.
+        The image encoder sees 3x1024x1024 inputs after 'preprocess' with
+        the default padding, so it is compiled for static shapes. Inputs
+        padded to other sizes would each be compiled again, so SamPredictor
+        rejects skip_padding with a compiled encoder. The mask decoder sees
+        256x64x64 embeddings but a varying number of prompts and points, so
+        dimensions that change between calls are made dynamic once instead
+        of recompiling for every prompt count. Compilation happens on the
+        first call with a new input shape.
+
+        Compiled kernels are stored in the inductor cache on disk, whose
+        location is set with the TORCHINDUCTOR_CACHE_DIR environment
+        variable, so after a restart the first call reuses them instead of
+        compiling again. If a compiled module fails, it warns and falls back
+        to eager execution from then on. Modules quantized to int8 and
+        modules that are already compiled are left as they are.
+        """
+        for module, dynamic in ((self.image_encoder, False), (self.mask_decoder, None)):
+            # Inductor lowers dynamically quantized linear layers with
+            # different rounding, so int8 modules stay eager
+            if module._compiled_call_impl is None and not any(
+                isinstance(m, torch.ao.nn.quantized.dynamic.Linear) for m in module.modules()
+            ):
+                _compile_with_fallback(module, dynamic)
+
     @torch.no_grad()
     def forward(
         self,
@@ -95,7 +156,7 @@ class Sam(nn.Module):
                 to subsequent iterations of prediction.
         """
         input_images = torch.stack([self.preprocess(x["image"]) for x in batched_input], dim=0)
-        image_embeddings = self.image_encoder(input_images)
+        image_embeddings = self.image_encoder(input_images.to(self.encoder_dtype))
 
         outputs = []
         for image_record, curr_embedding in zip(batched_input, image_embeddings):
@@ -115,6 +176,8 @@ class Sam(nn.Module):
                 dense_prompt_embeddings=dense_embeddings,
                 multimask_output=multimask_output,
             )
+            low_res_masks = low_res_masks.float()
+            iou_predictions = iou_predictions.float()
             masks = self.postprocess_masks(
                 low_res_masks,
                 input_size=image_record["image"].shape[-2:],
@@ -161,14 +224,102 @@ class Sam(nn.Module):
         masks = F.interpolate(masks, original_size, mode="bilinear", align_corners=False)
         return masks
 
-    def preprocess(self, x: torch.Tensor) -> torch.Tensor:
-        """Normalize pixel values and pad to a square input."""
+    def postprocess_masks_in_regions(
+        self,
+        masks: torch.Tensor,
+        input_size: Tuple[int, ...],
+        original_size: Tuple[int, ...],
+        regions: List[Tuple[int, int, int, int]],
+    ) -> List[torch.Tensor]:
+        """
+        Upscale masks to the original image size like 'postprocess_masks',
+        but only compute each mask within a region of the original image.
+        Both bilinear resizes are separable linear maps, so they are composed
+        into one small matrix per axis that takes the low resolution logits
+        straight to the region, and no full size mask is ever created.
+
+        Arguments:
+          masks (torch.Tensor): Batched masks from the mask_decoder,
+            in BxCxHxW format.
+          input_size (tuple(int, int)): The size of the image input to the
+            model, in (H, W) format. Used to remove padding.
+          original_size (tuple(int, int)): The original size of the image
+            before resizing for input to the model, in (H, W) format.
+          regions (list(tuple(int, int, int, int))): One region per mask in
+            XYXY format, in pixels of the original image, with exclusive
+            end coordinates.
+
+        Returns:
+          (list(torch.Tensor)): B masks, each in Cx(y1-y0)x(x1-x0) format.
+        """
+        img_size = self.image_encoder.img_size
+        low_h, low_w = masks.shape[-2:]
+        # Upscaling to the padded input size followed by cropping the padding
+        rows_to_input = _bilinear_weights(low_h, img_size, 0, input_size[0], masks.device)
+        cols_to_input = _bilinear_weights(low_w, img_size, 0, input_size[1], masks.device)
+
+        outputs = []
+        for mask, (x0, y0, x1, y1) in zip(masks, regions):
+            rows = _bilinear_weights(input_size[0], original_size[0], y0, y1, masks.device)
+            cols = _bilinear_weights(input_size[1], original_size[1], x0, x1, masks.device)
+            rows = rows @ rows_to_input
+            cols = cols @ cols_to_input
+            outputs.append(rows @ mask.float() @ cols.T)
+        return outputs
+
+    def preprocess(
+        self, x: torch.Tensor, pad_size: Optional[Tuple[int, int]] = None
+    ) -> torch.Tensor:
+        """Normalize pixel values and pad to a square input, or to pad_size if given."""
         # Normalize colors
         x = (x - self.pixel_mean) / self.pixel_std
 
         # Pad
         h, w = x.shape[-2:]
-        padh = self.image_encoder.img_size - h
-        padw = self.image_encoder.img_size - w
+        pad_h, pad_w = pad_size or (self.image_encoder.img_size, self.image_encoder.img_size)
+        padh = pad_h - h
+        padw = pad_w - w
         x = F.pad(x, (0, padw, 0, padh))
         return x
+
+
+def _bilinear_weights(
+    in_size: int, out_size: int, start: int, end: int, device: torch.device
+) -> torch.Tensor:
+    """
+    Returns the (end - start) x in_size matrix of weights that F.interpolate
+    in bilinear mode with align_corners=False applies along one axis, for
+    output positions start to end.
+    """
+    out_idx = torch.arange(start, end, device=device, dtype=torch.float32)
+    src = ((out_idx + 0.5) * (in_size / out_size) - 0.5).clamp(min=0)
+    lo = src.floor().long().clamp(max=in_size - 1)
+    hi = (lo + 1).clamp(max=in_size - 1)
+    frac = src - lo
+    row = torch.arange(end - start, device=device)
+    weights = torch.zeros(end - start, in_size, device=device)
+    weights.index_put_((row, lo), 1 - frac, accumulate=True)
+    weights.index_put_((row, hi), frac, accumulate=True)
+    return weights
+
+
+def _compile_with_fallback(module: nn.Module, dynamic: Optional[bool]) -> None:
+    """
+    Compiles a module in place like nn.Module.compile, except that if the
+    compiled call raises while the eager one succeeds, the module warns and
+    runs eagerly from then on. Errors of the eager call are raised as usual.
+    """
+    compiled_call = torch.compile(module._call_impl, dynamic=dynamic)
+
+    def call(*args: Any, **kwargs: Any) -> Any:
+        try:
+            return compiled_call(*args, **kwargs)
+        except Exception as e:
+            out = module._call_impl(*args, **kwargs)
+            warnings.warn(
+                f"Compiled {type(module).__name__} failed, running it eagerly instead: {e}"
+            )
+            module._compiled_call_impl = None
+            return out
+
+    module._compiled_call_impl = call
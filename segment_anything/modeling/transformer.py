@@ -4,10 +4,9 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
-import torch
+import torch.nn.functional as F
 from torch import Tensor, nn
 
-import math
 from typing import Tuple, Type
 
 from .common import MLPBlock
@@ -226,14 +225,14 @@ class Attention(nn.Module):
         k = self._separate_heads(k, self.num_heads)
         v = self._separate_heads(v, self.num_heads)
 
-        # Attention
-        _, _, _, c_per_head = q.shape
-        attn = q @ k.permute(0, 1, 3, 2)  # B x N_heads x N_tokens x N_tokens
-        attn = attn / math.sqrt(c_per_head)
-        attn = torch.softmax(attn, dim=-1)
+        # Inputs shared by all prompts may have batch size 1, broadcast them
+        b = max(q.shape[0], k.shape[0], v.shape[0])
+        q, k, v = q.expand(b, -1, -1, -1), k.expand(b, -1, -1, -1), v.expand(b, -1, -1, -1)
+
+        # Attention, fused so the B x N_heads x N_tokens x N_tokens scores are never stored
+        out = F.scaled_dot_product_attention(q, k, v)
 
         # Get output
-        out = attn @ v
         out = self._recombine_heads(out)
         out = self.out_proj(out)
 
@@ -0,0 +1,314 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+
+from typing import List, Optional, Tuple
+
+from .predictor import box_regions
+from .utils.transforms import ResizeLongestSide
+
+
+class SamOnnxPredictor:
+    def __init__(
+        self,
+        encoder_path: str,
+        decoder_path: str,
+        num_threads: Optional[int] = None,
+        img_size: int = 1024,
+        mask_threshold: float = 0.0,
+        image_format: str = "RGB",
+    ) -> None:
+        """
+        Runs SAM with ONNX Runtime on CPU, with the same interface as
+        SamPredictor: an image is set once with 'set_image', and masks are
+        then predicted for it with 'predict'. Requires onnxruntime.
+
+        The models are exported with 'export_image_encoder' and
+        'export_mask_decoder' in segment_anything.utils.onnx, the latter
+        with return_single_mask=False, and with batched=True for
+        'predict_boxes' to decode all boxes in one call. With
+        crop_to_box=True, 'predict_box_crops' receives masks already
+        thresholded and cropped from the graph, and logits can't be returned.
+
+        Arguments:
+          encoder_path (str): The path to the exported image encoder.
+          decoder_path (str): The path to the exported mask decoder.
+          num_threads (int or None): The number of threads each session uses
+            within an operator. If None, ONNX Runtime picks the number of
+            physical cores.
+          img_size (int): The input size of the image encoder.
+          mask_threshold (float): The threshold applied to the mask logits.
+          image_format (str): The color format the image encoder expects.
+        """
+        import onnxruntime  # type: ignore
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+        self.encoder = onnxruntime.InferenceSession(
+            encoder_path, sess_options=options, providers=providers
+        )
+        self.decoder = onnxruntime.InferenceSession(
+            decoder_path, sess_options=options, providers=providers
+        )
+        self.mask_threshold = mask_threshold
+        # Whether the decoder was exported with a dynamic prompt axis
+        self.batched = isinstance(self.decoder.get_inputs()[1].shape[0], str)
+        # Whether the decoder returns thresholded masks cropped to crop_boxes
+        self.crop_to_box = "crop_boxes" in [x.name for x in self.decoder.get_inputs()]
+        self.image_format = image_format
+        self.transform = ResizeLongestSide(img_size)
+        self.reset_image()
+
+    def set_image(
+        self,
+        image: np.ndarray,
+        image_format: str = "RGB",
+    ) -> None:
+        """
+        Calculates the image embeddings for the provided image, allowing
+        masks to be predicted with the 'predict' method.
+
+        Arguments:
+          image (np.ndarray): The image for calculating masks. Expects an
+            image in HWC uint8 format, with pixel values in [0, 255].
+          image_format (str): The color format of the image, in ['RGB', 'BGR'].
+        """
+        assert image_format in [
+            "RGB",
+            "BGR",
+        ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+        if image_format != self.image_format:
+            image = image[..., ::-1]
+
+        self.reset_image()
+        input_image = np.ascontiguousarray(self.transform.apply_image(image))
+        (self.features,) = self.encoder.run(None, {"input_image": input_image})
+        self.original_size = image.shape[:2]
+        self.input_size = input_image.shape[:2]
+        self.is_image_set = True
+
+    def predict(
+        self,
+        point_coords: Optional[np.ndarray] = None,
+        point_labels: Optional[np.ndarray] = None,
+        box: Optional[np.ndarray] = None,
+        mask_input: Optional[np.ndarray] = None,
+        multimask_output: bool = True,
+        return_logits: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Predict masks for the given input prompts, using the currently set
+        image. Arguments and return values are the same as for
+        SamPredictor.predict.
+        """
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+
+        # Points and box corners share one prompt, as in the prompt encoder,
+        # which also appends a padding point to points given without a box
+        coords: List[np.ndarray] = [np.zeros((0, 2), dtype=np.float32)]
+        labels: List[np.ndarray] = [np.zeros(0, dtype=np.float32)]
+        if point_coords is not None:
+            assert (
+                point_labels is not None
+            ), "point_labels must be supplied if point_coords is supplied."
+            coords.append(self.transform.apply_coords(point_coords, self.original_size))
+            labels.append(np.asarray(point_labels, dtype=np.float32))
+            if box is None:
+                coords.append(np.zeros((1, 2), dtype=np.float32))
+                labels.append(np.array([-1], dtype=np.float32))
+        if box is not None:
+            box = self.transform.apply_boxes(box, self.original_size)
+            coords.append(box.reshape(2, 2))
+            labels.append(np.array([2, 3], dtype=np.float32))
+
+        if mask_input is not None:
+            mask_input = np.asarray(mask_input, dtype=np.float32)[None, :, :, :]
+            has_mask_input = np.ones(1, dtype=np.float32)
+        else:
+            mask_size = [4 * x for x in self.features.shape[-2:]]
+            mask_input = np.zeros((1, 1, *mask_size), dtype=np.float32)
+            has_mask_input = np.zeros(1, dtype=np.float32)
+
+        masks, iou_predictions, low_res_masks = self._decode(
+            np.concatenate(coords, axis=0)[None, :, :],
+            np.concatenate(labels, axis=0)[None, :],
+            mask_input,
+            has_mask_input,
+            multimask_output,
+            return_logits,
+        )
+        return masks[0], iou_predictions[0], low_res_masks[0]
+
+    def predict_boxes(
+        self,
+        boxes: np.ndarray,
+        multimask_output: bool = False,
+        return_logits: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Predict masks for several box prompts on the currently set image.
+        With a decoder exported with batched=True, all boxes are decoded
+        in a single session run. Otherwise the boxes are decoded one by one.
+
+        Arguments:
+          boxes (np.ndarray): A Bx4 array of box prompts, in XYXY format.
+          multimask_output (bool): If true, the model will return three masks
+            per box.
+          return_logits (bool): If true, returns un-thresholded masks logits
+            instead of a binary mask.
+
+        Returns:
+          (np.ndarray): The output masks in BxCxHxW format, where C is the
+            number of masks, and (H, W) is the original image size.
+          (np.ndarray): An array of shape BxC containing the model's
+            predictions for the quality of each mask.
+          (np.ndarray): An array of shape BxCxHxW, where H=W=256, with the
+            low resolution logits.
+        """
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        return self._predict_boxes(boxes, multimask_output, return_logits)
+
+    def predict_box_crops(
+        self,
+        boxes: np.ndarray,
+        margin: int = 0,
+        multimask_output: bool = False,
+    ) -> Tuple[List[np.ndarray], np.ndarray, np.ndarray]:
+        """
+        Predict masks for several box prompts on the currently set image,
+        each only within its box plus a margin. Arguments and return values
+        are the same as for SamPredictor.predict_box_crops. With a decoder
+        exported with crop_to_box=True, the masks are thresholded and
+        cropped inside the graph, so only the box regions are computed and
+        returned.
+        """
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        regions = box_regions(boxes, margin, self.original_size)
+        masks, iou_predictions, _ = self._predict_boxes(boxes, multimask_output, False, regions)
+        if self.crop_to_box:
+            # Each mask starts at the top-left corner of its region
+            regions_in_masks = regions - np.tile(regions[:, :2], 2)
+        else:
+            regions_in_masks = regions
+        crop_masks = [
+            m[:, y0:y1, x0:x1] for m, (x0, y0, x1, y1) in zip(masks, regions_in_masks)
+        ]
+        return crop_masks, iou_predictions, regions
+
+    def _predict_boxes(
+        self,
+        boxes: np.ndarray,
+        multimask_output: bool,
+        return_logits: bool,
+        regions: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Decodes Bx4 boxes given in the original frame."""
+        boxes = self.transform.apply_boxes(boxes, self.original_size)
+        coords = boxes.reshape(-1, 2, 2)
+        labels = np.tile(np.array([[2, 3]], dtype=np.float32), (len(coords), 1))
+        mask_size = [4 * x for x in self.features.shape[-2:]]
+        mask_input = np.zeros((1, 1, *mask_size), dtype=np.float32)
+        has_mask_input = np.zeros(1, dtype=np.float32)
+
+        if self.batched:
+            return self._decode(
+                coords, labels, mask_input, has_mask_input, multimask_output, return_logits, regions
+            )
+        outputs = [
+            self._decode(
+                coords[i : i + 1],
+                labels[i : i + 1],
+                mask_input,
+                has_mask_input,
+                multimask_output,
+                return_logits,
+                None if regions is None else regions[i : i + 1],
+            )
+            for i in range(len(coords))
+        ]
+        # Masks cropped to their regions are padded to the largest one,
+        # as a batched decoder would return them
+        masks = [x[0] for x in outputs]
+        crop_h = max(m.shape[-2] for m in masks)
+        crop_w = max(m.shape[-1] for m in masks)
+        masks = [
+            np.pad(m, ((0, 0), (0, 0), (0, crop_h - m.shape[-2]), (0, crop_w - m.shape[-1])))
+            for m in masks
+        ]
+        return (
+            np.concatenate(masks, axis=0),
+            np.concatenate([x[1] for x in outputs], axis=0),
+            np.concatenate([x[2] for x in outputs], axis=0),
+        )
+
+    def _decode(
+        self,
+        point_coords: np.ndarray,
+        point_labels: np.ndarray,
+        mask_input: np.ndarray,
+        has_mask_input: np.ndarray,
+        multimask_output: bool,
+        return_logits: bool,
+        crop_boxes: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Runs the decoder session on prompts in the input frame."""
+        inputs = {
+            "image_embeddings": self.features,
+            "point_coords": point_coords.astype(np.float32),
+            "point_labels": point_labels.astype(np.float32),
+            "mask_input": mask_input,
+            "has_mask_input": has_mask_input,
+            "orig_im_size": np.array(self.original_size, dtype=np.float32),
+        }
+        if self.crop_to_box:
+            if return_logits:
+                raise ValueError("A decoder exported with crop_to_box can't return logits.")
+            if crop_boxes is None:
+                # Without a region the masks cover the whole image
+                h, w = self.original_size
+                crop_boxes = np.array([[0, 0, w, h]] * len(point_coords))
+            inputs["crop_boxes"] = crop_boxes.astype(np.float32)
+        masks, iou_predictions, low_res_masks = self.decoder.run(None, inputs)
+
+        # Select the correct mask or masks for output
+        mask_slice = slice(1, None) if multimask_output else slice(0, 1)
+        masks = masks[:, mask_slice]
+        if self.crop_to_box:
+            masks = masks.astype(bool)
+        elif not return_logits:
+            masks = masks > self.mask_threshold
+        return masks, iou_predictions[:, mask_slice], low_res_masks[:, mask_slice]
+
+    def get_image_embedding(self) -> np.ndarray:
+        """
+        Returns the image embeddings for the currently set image, with
+        shape 1xCxHxW, where C is the embedding dimension and (H,W) are
+        the embedding spatial dimension of SAM (typically C=256, H=W=64).
+        """
+        if not self.is_image_set:
+            raise RuntimeError(
+                "An image must be set with .set_image(...) to generate an embedding."
+            )
+        assert self.features is not None, "Features must exist if an image has been set."
+        return self.features
+
+    def reset_image(self) -> None:
+        """Resets the currently set image."""
+        self.is_image_set = False
+        self.features = None
+        self.original_size = None
+        self.input_size = None
@@ -9,15 +9,38 @@ import torch
 
 from segment_anything.modeling import Sam
 
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
+from .utils.embedding_cache import ImageEmbeddingCache
 from .utils.transforms import ResizeLongestSide
 
 
+class ImageEmbedding:
+    """
+    The image embedding of a single image together with the sizes needed
+    to map prompts and masks between the original and the input frame.
+    Returned by 'SamPredictor.encode_batch' and made the current image of
+    a predictor with 'SamPredictor.set_image_embedding'.
+    """
+
+    def __init__(
+        self,
+        features: torch.Tensor,
+        original_size: Tuple[int, ...],
+        input_size: Tuple[int, ...],
+    ) -> None:
+        self.features = features
+        self.original_size = original_size
+        self.input_size = input_size
+
+
 class SamPredictor:
     def __init__(
         self,
         sam_model: Sam,
+        embedding_cache: Optional[ImageEmbeddingCache] = None,
+        compile: bool = False,
+        skip_padding: bool = False,
     ) -> None:
         """
         Uses SAM to calculate the image embedding for an image, and then
@@ -25,9 +48,30 @@ class SamPredictor:
 
         Arguments:
           sam_model (Sam): The model to use for mask prediction.
+          embedding_cache (ImageEmbeddingCache or None): If provided, image
+            embeddings computed by 'set_image' are stored in and reloaded
+            from this cache, skipping the image encoder for known images.
+            Entries are also keyed by the dtype of the image encoder, whether
+            it is quantized and whether padding is skipped.
+          compile (bool): If true, compiles the image encoder and the mask
+            decoder of the model with 'Sam.compile_for_inference'.
+          skip_padding (bool): If true, images are padded only to a multiple
+            of the patch size instead of to a square, and the image encoder
+            runs on that smaller token grid, skipping the padded tokens of
+            non-square images. Images in one batch are padded to their
+            largest size. The image embeddings approximate those of the
+            padded input, and are zero outside the image. The image encoder
+            then sees a different input size for every image shape, so it
+            can't be combined with a compiled image encoder.
         """
         super().__init__()
+        if skip_padding and (compile or _is_compiled(sam_model.image_encoder)):
+            raise ValueError("skip_padding can't be combined with a compiled image encoder.")
         self.model = sam_model
+        if compile:
+            self.model.compile_for_inference()
+        self.skip_padding = skip_padding
+        self.embedding_cache = embedding_cache
         self.transform = ResizeLongestSide(sam_model.image_encoder.img_size)
         self.reset_image()
 
@@ -52,6 +96,13 @@ class SamPredictor:
         if image_format != self.model.image_format:
             image = image[..., ::-1]
 
+        if self.embedding_cache is not None:
+            cache_key = self.embedding_cache.key(image, self._cache_variant())
+            cached = self.embedding_cache.get(cache_key, self.device)
+            if cached is not None:
+                self.set_image_embedding(ImageEmbedding(*cached))
+                return
+
         # Transform the image to the form expected by the model
         input_image = self.transform.apply_image(image)
         input_image_torch = torch.as_tensor(input_image, device=self.device)
@@ -59,6 +110,11 @@ class SamPredictor:
 
         self.set_torch_image(input_image_torch, image.shape[:2])
 
+        if self.embedding_cache is not None:
+            self.features = self.embedding_cache.put(
+                cache_key, self.features, self.original_size, self.input_size
+            )
+
     @torch.no_grad()
     def set_torch_image(
         self,
@@ -85,8 +141,89 @@ class SamPredictor:
 
         self.original_size = original_image_size
         self.input_size = tuple(transformed_image.shape[-2:])
-        input_image = self.model.preprocess(transformed_image)
-        self.features = self.model.image_encoder(input_image)
+        input_image = self.model.preprocess(transformed_image, self._pad_size([self.input_size]))
+        self.features = self.model.image_encoder(input_image.to(self.model.encoder_dtype)).float()
+        self.is_image_set = True
+
+    @torch.no_grad()
+    def encode_batch(
+        self,
+        images: List[np.ndarray],
+        image_format: str = "RGB",
+        batch_size: int = 4,
+    ) -> List[ImageEmbedding]:
+        """
+        Calculates the image embeddings for several images, running the
+        image encoder on up to 'batch_size' images per forward pass. Does
+        not change the currently set image.
+
+        Arguments:
+          images (list(np.ndarray)): The images to encode, each in HWC uint8
+            format with pixel values in [0, 255]. Images may differ in size.
+          image_format (str): The color format of the images, in ['RGB', 'BGR'].
+          batch_size (int): The number of images encoded simultaneously.
+
+        Returns:
+          (list(ImageEmbedding)): One embedding per input image, in order.
+            Pass one to 'set_image_embedding' to predict masks for it.
+        """
+        assert image_format in [
+            "RGB",
+            "BGR",
+        ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+        assert batch_size > 0, "batch_size must be positive."
+
+        embeddings: List[Optional[ImageEmbedding]] = [None] * len(images)
+        pending = []
+        for i, image in enumerate(images):
+            if image_format != self.model.image_format:
+                image = image[..., ::-1]
+            cache_key = None
+            if self.embedding_cache is not None:
+                cache_key = self.embedding_cache.key(image, self._cache_variant())
+                cached = self.embedding_cache.get(cache_key, self.device)
+                if cached is not None:
+                    embeddings[i] = ImageEmbedding(*cached)
+                    continue
+            pending.append((i, cache_key, image))
+
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start : start + batch_size]
+            input_images, input_sizes = [], []
+            for _, _, image in batch:
+                input_image = self.transform.apply_image(image)
+                input_image_torch = torch.as_tensor(input_image, device=self.device)
+                input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()
+                input_sizes.append(tuple(input_image_torch.shape[-2:]))
+                input_images.append(input_image_torch)
+            pad_size = self._pad_size(input_sizes)
+            input_images = [self.model.preprocess(x, pad_size) for x in input_images]
+            input_batch = torch.stack(input_images, dim=0).to(self.model.encoder_dtype)
+            features = self.model.image_encoder(input_batch).float()
+
+            for j, (i, cache_key, image) in enumerate(batch):
+                embedding = ImageEmbedding(features[j : j + 1], image.shape[:2], input_sizes[j])
+                if self.embedding_cache is not None:
+                    embedding.features = self.embedding_cache.put(
+                        cache_key, embedding.features, embedding.original_size, embedding.input_size
+                    )
+                embeddings[i] = embedding
+
+        return embeddings  # type: ignore
+
+    def set_image_embedding(self, embedding: ImageEmbedding) -> None:
+        """
+        Makes a precomputed image embedding the current image, allowing
+        masks to be predicted with the 'predict' method without running
+        the image encoder.
+
+        Arguments:
+          embedding (ImageEmbedding): An embedding returned by 'encode_batch'.
+        """
+        self.reset_image()
+        self.features = embedding.features
+        self.original_size = embedding.original_size
+        self.input_size = embedding.input_size
         self.is_image_set = True
 
     def predict(
@@ -213,6 +350,76 @@ class SamPredictor:
         if not self.is_image_set:
             raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
 
+        low_res_masks, iou_predictions = self._predict_low_res(
+            point_coords, point_labels, boxes, mask_input, multimask_output
+        )
+
+        # Upscale the masks to the original image resolution
+        masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
+
+        if not return_logits:
+            masks = masks > self.model.mask_threshold
+
+        return masks, iou_predictions, low_res_masks
+
+    @torch.no_grad()
+    def predict_box_crops(
+        self,
+        boxes: np.ndarray,
+        margin: int = 0,
+        multimask_output: bool = False,
+    ) -> Tuple[List[np.ndarray], np.ndarray, np.ndarray]:
+        """
+        Predict masks for a batch of box prompts, using the currently set
+        image. Unlike 'predict_torch', each mask is upscaled only within its
+        box plus a margin, directly from the low resolution logits to the
+        original image resolution, and is returned thresholded. Memory and
+        time then scale with the box area rather than the image area.
+
+        Arguments:
+          boxes (np.ndarray): A Bx4 array of box prompts in XYXY format, in
+            pixels of the original image.
+          margin (int): The number of pixels to extend each box by on every
+            side when choosing the region to upscale.
+          multimask_output (bool): If true, the model will return three masks
+            per box. See 'predict' for details.
+
+        Returns:
+          (list(np.ndarray)): B boolean masks, each in CxhxW format covering
+            its region, where C is the number of masks per box.
+          (np.ndarray): An array of shape BxC containing the model's
+            predictions for the quality of each mask.
+          (np.ndarray): A Bx4 integer array with the region of each mask in
+            XYXY format, in pixels of the original image. The end
+            coordinates are exclusive.
+        """
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        regions = box_regions(boxes, margin, self.original_size)
+
+        box_torch = self.transform.apply_boxes(boxes, self.original_size)
+        box_torch = torch.as_tensor(box_torch, dtype=torch.float, device=self.device)
+        low_res_masks, iou_predictions = self._predict_low_res(
+            None, None, box_torch, None, multimask_output
+        )
+
+        masks = self.model.postprocess_masks_in_regions(
+            low_res_masks, self.input_size, self.original_size, regions.tolist()
+        )
+        masks_np = [(m > self.model.mask_threshold).cpu().numpy() for m in masks]
+        return masks_np, iou_predictions.cpu().numpy(), regions
+
+    def _predict_low_res(
+        self,
+        point_coords: Optional[torch.Tensor],
+        point_labels: Optional[torch.Tensor],
+        boxes: Optional[torch.Tensor],
+        mask_input: Optional[torch.Tensor],
+        multimask_output: bool,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Runs the prompt encoder and mask decoder, returning float32 low res logits and scores."""
         if point_coords is not None:
             points = (point_coords, point_labels)
         else:
@@ -233,14 +440,31 @@ class SamPredictor:
             dense_prompt_embeddings=dense_embeddings,
             multimask_output=multimask_output,
         )
+        return low_res_masks.float(), iou_predictions.float()
 
-        # Upscale the masks to the original image resolution
-        masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
-
-        if not return_logits:
-            masks = masks > self.model.mask_threshold
-
-        return masks, iou_predictions, low_res_masks
+    def _pad_size(self, input_sizes: List[Tuple[int, ...]]) -> Optional[Tuple[int, int]]:
+        """
+        Returns the size images of the given input sizes are padded to for
+        the image encoder, or None for the full square input.
+        """
+        if not self.skip_padding:
+            return None
+        encoder = self.model.image_encoder
+        if _is_compiled(encoder):
+            raise ValueError("skip_padding can't be combined with a compiled image encoder.")
+        patch_size = encoder.img_size // encoder.embed_size
+        h = max(size[0] for size in input_sizes)
+        w = max(size[1] for size in input_sizes)
+        return (-(-h // patch_size) * patch_size, -(-w // patch_size) * patch_size)
+
+    def _cache_variant(self) -> str:
+        """Describes the encoder configuration, which the embeddings depend on."""
+        variant = str(self.model.encoder_dtype)
+        if self.model.encoder_quantized:
+            variant += ":int8"
+        if self.skip_padding:
+            variant += ":skip_padding"
+        return variant
 
     def get_image_embedding(self) -> torch.Tensor:
         """
@@ -267,3 +491,22 @@ class SamPredictor:
         self.orig_w = None
         self.input_h = None
         self.input_w = None
+
+
+def box_regions(boxes: np.ndarray, margin: int, image_size: Tuple[int, ...]) -> np.ndarray:
+    """
+    Returns the pixel region covered by each of the Bx4 XYXY boxes extended
+    by margin on every side and clipped to the image of size (H, W), as a
+    Bx4 integer array in XYXY format with exclusive end coordinates.
+    """
+    h, w = image_size
+    regions = np.concatenate(
+        [np.floor(boxes[:, :2] - margin), np.ceil(boxes[:, 2:] + margin)], axis=1
+    )
+    regions = np.clip(regions, 0, [w, h, w, h]).astype(np.int64)
+    regions[:, 2:] = np.maximum(regions[:, 2:], regions[:, :2])
+    return regions
+
+
+def _is_compiled(module: torch.nn.Module) -> bool:
+    return module._compiled_call_impl is not None
@@ -10,71 +10,238 @@ import torch
 import math
 from copy import deepcopy
 from itertools import product
-from typing import Any, Dict, Generator, ItemsView, List, Tuple
+from typing import Any, Dict, Generator, ItemsView, List, Tuple, Union
 
 
 class MaskData:
     """
     A structure for storing masks and their related data in batched format.
-    Implements basic filtering and concatenation.
+    Implements basic filtering and concatenation. Tensors and arrays are
+    kept in preallocated buffers that grow geometrically, so repeated
+    concatenation is amortized O(1) per mask, and RLEs are kept in an
+    RleArray rather than a list of dicts.
     """
 
     def __init__(self, **kwargs) -> None:
         for v in kwargs.values():
             assert isinstance(
-                v, (list, np.ndarray, torch.Tensor)
-            ), "MaskData only supports list, numpy arrays, and torch tensors."
+                v, (list, np.ndarray, torch.Tensor, RleArray)
+            ), "MaskData only supports list, numpy arrays, torch tensors and RleArray."
         self._stats = dict(**kwargs)
+        # The number of valid rows in each buffer, which may have spare capacity
+        self._sizes = {k: len(v) for k, v in kwargs.items()}
 
     def __setitem__(self, key: str, item: Any) -> None:
         assert isinstance(
-            item, (list, np.ndarray, torch.Tensor)
-        ), "MaskData only supports list, numpy arrays, and torch tensors."
+            item, (list, np.ndarray, torch.Tensor, RleArray)
+        ), "MaskData only supports list, numpy arrays, torch tensors and RleArray."
         self._stats[key] = item
+        self._sizes[key] = len(item)
 
     def __delitem__(self, key: str) -> None:
         del self._stats[key]
+        del self._sizes[key]
 
     def __getitem__(self, key: str) -> Any:
-        return self._stats[key]
+        v = self._stats[key]
+        if isinstance(v, (torch.Tensor, np.ndarray)):
+            return v[: self._sizes[key]]
+        return v
 
     def items(self) -> ItemsView[str, Any]:
-        return self._stats.items()
+        return {k: self[k] for k in self._stats}.items()
 
     def filter(self, keep: torch.Tensor) -> None:
-        for k, v in self._stats.items():
+        for k, v in self.items():
             if v is None:
                 self._stats[k] = None
             elif isinstance(v, torch.Tensor):
                 self._stats[k] = v[torch.as_tensor(keep, device=v.device)]
             elif isinstance(v, np.ndarray):
                 self._stats[k] = v[keep.detach().cpu().numpy()]
+            elif isinstance(v, RleArray):
+                v.filter(keep)
             elif isinstance(v, list) and keep.dtype == torch.bool:
                 self._stats[k] = [a for i, a in enumerate(v) if keep[i]]
             elif isinstance(v, list):
                 self._stats[k] = [v[i] for i in keep]
             else:
                 raise TypeError(f"MaskData key {k} has an unsupported type {type(v)}.")
+            if v is not None:
+                self._sizes[k] = len(self._stats[k])
 
     def cat(self, new_stats: "MaskData") -> None:
         for k, v in new_stats.items():
             if k not in self._stats or self._stats[k] is None:
-                self._stats[k] = deepcopy(v)
-            elif isinstance(v, torch.Tensor):
-                self._stats[k] = torch.cat([self._stats[k], v], dim=0)
-            elif isinstance(v, np.ndarray):
-                self._stats[k] = np.concatenate([self._stats[k], v], axis=0)
+                size = 0
+                self._stats[k] = v.clone() if isinstance(v, torch.Tensor) else deepcopy(v)
+            elif isinstance(v, (torch.Tensor, np.ndarray)):
+                size = self._sizes[k]
+                self._stats[k] = self._append(self._stats[k], size, v)
+            elif isinstance(v, RleArray):
+                size = self._sizes[k]
+                self._stats[k].cat(v)
             elif isinstance(v, list):
+                size = self._sizes[k]
                 self._stats[k] = self._stats[k] + deepcopy(v)
             else:
                 raise TypeError(f"MaskData key {k} has an unsupported type {type(v)}.")
+            self._sizes[k] = size + len(v)
+
+    @staticmethod
+    def _append(buffer: Any, size: int, new: Any) -> Any:
+        """Writes new rows after the first size rows of buffer, growing it if full."""
+        # Like torch.cat, empty inputs are skipped whatever their shape
+        if len(new) == 0:
+            return buffer
+        if size == 0:
+            return new.clone() if isinstance(new, torch.Tensor) else new.copy()
+        if size + len(new) > len(buffer):
+            capacity = max(2 * len(buffer), size + len(new))
+            if isinstance(buffer, torch.Tensor):
+                grown = buffer.new_empty((capacity,) + buffer.shape[1:])
+            else:
+                grown = np.empty((capacity,) + buffer.shape[1:], dtype=buffer.dtype)
+            grown[:size] = buffer[:size]
+            buffer = grown
+        buffer[size : size + len(new)] = new
+        return buffer
 
     def to_numpy(self) -> None:
-        for k, v in self._stats.items():
+        for k, v in self.items():
             if isinstance(v, torch.Tensor):
                 self._stats[k] = v.detach().cpu().numpy()
 
 
+class RleArray:
+    """
+    A batch of uncompressed RLEs of masks with the same size. The counts of
+    all masks are stored in one flat int32 buffer, with the start and
+    length of each mask's counts, instead of a list of dicts of lists.
+    Indexing returns an RLE in the format expected by pycoco tools.
+    """
+
+    def __init__(self, size: List[int]) -> None:
+        """
+        Arguments:
+          size (list(int)): The size of the masks, in (H, W) format.
+        """
+        self.size = list(size)
+        self._counts = np.zeros(0, dtype=np.int32)
+        self._used = 0
+        self._starts = np.zeros(0, dtype=np.int64)
+        self._lengths = np.zeros(0, dtype=np.int64)
+
+    @classmethod
+    def from_masks(cls, tensor: torch.Tensor) -> "RleArray":
+        """Encodes a batch of binary masks in BxHxW format."""
+        # Put in fortran order and flatten h,w
+        b, h, w = tensor.shape
+        tensor = tensor.permute(0, 2, 1).flatten(1)
+
+        # Compute change indices, sorted by mask and then by position
+        diff = tensor[:, 1:] ^ tensor[:, :-1]
+        change_indices = diff.nonzero()
+        mask_ids, positions = change_indices[:, 0], change_indices[:, 1] + 1
+
+        # Lay out the run boundaries of all masks in one flat array, with each
+        # mask's change positions followed by an end marker at h * w
+        num_changes = torch.bincount(mask_ids, minlength=b)
+        end_idxs = torch.cumsum(num_changes + 1, dim=0) - 1
+        ends = torch.full(
+            (change_indices.shape[0] + b,), h * w, dtype=positions.dtype, device=positions.device
+        )
+        ends[torch.arange(change_indices.shape[0], device=mask_ids.device) + mask_ids] = positions
+        starts = torch.zeros_like(ends)
+        starts[1:] = ends[:-1]
+        starts[end_idxs - num_changes] = 0
+        run_lengths = ends - starts
+
+        # Masks starting with a foreground pixel begin with a count of zero
+        first_values = tensor[:, 0].long()
+        lengths = num_changes + 1 + first_values
+        shift = torch.cumsum(first_values, dim=0)
+        counts = torch.zeros(int(lengths.sum()), dtype=torch.int32, device=tensor.device)
+        run_mask_ids = torch.repeat_interleave(torch.arange(b, device=tensor.device), num_changes + 1)
+        counts[torch.arange(len(run_lengths), device=tensor.device) + shift[run_mask_ids]] = (
+            run_lengths.int()
+        )
+
+        # Transfer to the cpu only once
+        rles = cls([h, w])
+        rles._counts = counts.cpu().numpy()
+        rles._used = len(rles._counts)
+        rles._lengths = lengths.cpu().numpy()
+        rles._starts = np.cumsum(rles._lengths) - rles._lengths
+        return rles
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __getitem__(self, idx: int) -> Dict[str, Any]:
+        return {"size": list(self.size), "counts": self.get_counts(idx).tolist()}
+
+    def __setitem__(self, idx: int, rle: Dict[str, Any]) -> None:
+        counts = np.asarray(rle["counts"], dtype=np.int32)
+        self._starts[idx] = self._append(counts)
+        self._lengths[idx] = len(counts)
+
+    def __iter__(self) -> Generator[Dict[str, Any], None, None]:
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def get_counts(self, idx: int) -> np.ndarray:
+        """Returns the counts of one RLE as a view into the flat buffer."""
+        start = self._starts[idx]
+        return self._counts[start : start + self._lengths[idx]]
+
+    def _append(self, counts: np.ndarray) -> int:
+        """Appends counts to the flat buffer, growing it if full, and returns their start."""
+        start = self._used
+        self._counts = MaskData._append(self._counts, start, counts)
+        self._used += len(counts)
+        return start
+
+    def _gather(self, idxs: np.ndarray) -> np.ndarray:
+        """Returns the concatenated counts of the given RLEs."""
+        if len(idxs) == 0:
+            return np.zeros(0, dtype=np.int32)
+        starts, lengths = self._starts[idxs].tolist(), self._lengths[idxs].tolist()
+        return np.concatenate([self._counts[s : s + n] for s, n in zip(starts, lengths)])
+
+    def filter(self, keep: Any) -> None:
+        """Keeps the RLEs selected by a boolean mask or an index array, in place."""
+        keep = np.asarray(torch.as_tensor(keep).cpu())
+        if keep.dtype == bool:
+            keep = np.flatnonzero(keep)
+        self._counts = self._gather(keep)
+        self._used = len(self._counts)
+        self._lengths = self._lengths[keep]
+        self._starts = np.cumsum(self._lengths) - self._lengths
+
+    def cat(self, other: "RleArray") -> None:
+        """Appends the RLEs of another RleArray, in place."""
+        start = self._append(other._gather(np.arange(len(other))))
+        self._starts = np.concatenate(
+            [self._starts, start + np.cumsum(other._lengths) - other._lengths]
+        )
+        self._lengths = np.concatenate([self._lengths, other._lengths])
+
+    def areas(self) -> np.ndarray:
+        """Computes the area in pixels of every mask."""
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        # Foreground runs are at odd positions within each RLE, which is an odd
+        # or even position in the concatenated counts depending on its start
+        counts = self._gather(np.arange(len(self))).astype(np.int64)
+        starts = np.cumsum(self._lengths) - self._lengths
+        odd, even = counts.copy(), counts
+        odd[0::2] = 0
+        even[1::2] = 0
+        odd_sums, even_sums = np.add.reduceat(odd, starts), np.add.reduceat(even, starts)
+        return np.where(starts % 2 == 0, odd_sums, even_sums)
+
+
 def is_box_near_crop_edge(
     boxes: torch.Tensor, crop_box: List[int], orig_box: List[int], atol: float = 20.0
 ) -> torch.Tensor:
@@ -109,46 +276,37 @@ def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
     Encodes masks to an uncompressed RLE, in the format expected by
     pycoco tools.
     """
-    # Put in fortran order and flatten h,w
-    b, h, w = tensor.shape
-    tensor = tensor.permute(0, 2, 1).flatten(1)
-
-    # Compute change indices
-    diff = tensor[:, 1:] ^ tensor[:, :-1]
-    change_indices = diff.nonzero()
-
-    # Encode run length
-    out = []
-    for i in range(b):
-        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
-        cur_idxs = torch.cat(
-            [
-                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
-                cur_idxs + 1,
-                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
-            ]
-        )
-        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
-        counts = [] if tensor[i, 0] == 0 else [0]
-        counts.extend(btw_idxs.detach().cpu().tolist())
-        out.append({"size": [h, w], "counts": counts})
-    return out
+    return list(RleArray.from_masks(tensor))
 
 
 def rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
     """Compute a binary mask from an uncompressed RLE."""
     h, w = rle["size"]
-    mask = np.empty(h * w, dtype=bool)
-    idx = 0
-    parity = False
-    for count in rle["counts"]:
-        mask[idx : idx + count] = parity
-        idx += count
-        parity ^= True
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    # Runs alternate between background and foreground, starting with background
+    mask = np.repeat(np.arange(len(counts)) % 2 == 1, counts)
     mask = mask.reshape(w, h)
     return mask.transpose()  # Put in C order
 
 
+def rles_to_masks(rles: Union[List[Dict[str, Any]], RleArray]) -> np.ndarray:
+    """
+    Compute binary masks from a list of uncompressed RLEs of the same size,
+    decoding them into a single preallocated NxHxW array.
+    """
+    if len(rles) == 0:
+        return np.zeros((0, 0, 0), dtype=bool)
+    h, w = rles[0]["size"]
+    masks = np.empty((len(rles), w, h), dtype=bool)
+    for i in range(len(rles)):
+        if isinstance(rles, RleArray):
+            counts = rles.get_counts(i)
+        else:
+            counts = np.asarray(rles[i]["counts"], dtype=np.int64)
+        masks[i] = np.repeat(np.arange(len(counts)) % 2 == 1, counts).reshape(w, h)
+    return masks.transpose(0, 2, 1)  # Put each mask in C order
+
+
 def area_from_rle(rle: Dict[str, Any]) -> int:
     return sum(rle["counts"][1::2])
 
@@ -275,8 +433,21 @@ def remove_small_regions(
 
     assert mode in ["holes", "islands"]
     correct_holes = mode == "holes"
-    working_mask = (correct_holes ^ mask).astype(np.uint8)
+    h, w = mask.shape
+
+    # Work on the mask's bounding box plus a one pixel background border when
+    # that border lies inside the image. Everything outside the box is then a
+    # single background region touching the border, so the result is the same
+    # as on the full mask once that region is given its full size.
+    rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    crop = None
+    if len(rows) > 0 and rows[0] > 0 and cols[0] > 0 and rows[-1] < h - 1 and cols[-1] < w - 1:
+        crop = (slice(rows[0] - 1, rows[-1] + 2), slice(cols[0] - 1, cols[-1] + 2))
+
+    working_mask = (correct_holes ^ (mask[crop] if crop is not None else mask)).astype(np.uint8)
     n_labels, regions, stats, _ = cv2.connectedComponentsWithStats(working_mask, 8)
+    if crop is not None and correct_holes:
+        stats[regions[0, 0], -1] += h * w - regions.size
     sizes = stats[:, -1][1:]  # Row 0 is background label
     small_regions = [i + 1 for i, s in enumerate(sizes) if s < area_thresh]
     if len(small_regions) == 0:
@@ -287,8 +458,11 @@ def remove_small_regions(
         # If every region is below threshold, keep largest
         if len(fill_labels) == 0:
             fill_labels = [int(np.argmax(sizes)) + 1]
-    mask = np.isin(regions, fill_labels)
-    return mask, True
+    if crop is None:
+        return np.isin(regions, fill_labels), True
+    new_mask = np.zeros_like(mask)
+    new_mask[crop] = np.isin(regions, fill_labels)
+    return new_mask, True
 
 
 def coco_encode_rle(uncompressed_rle: Dict[str, Any]) -> Dict[str, Any]:
@@ -0,0 +1,182 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+class ImageEmbeddingCache:
+    """
+    A persistent on-disk cache of image embeddings, so that images that
+    are segmented repeatedly only pay for the image encoder once. Entries
+    are keyed by a hash of the image content together with the model
+    variant, the checkpoint and how the model is run, and are stored as
+    float16 .npy files. The cache is bounded in size and evicts the least
+    recently used entries first.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        model_type: str,
+        checkpoint: Optional[str] = None,
+        max_size_bytes: int = 2 * 1024**3,
+        dtype: np.dtype = np.float16,
+    ) -> None:
+        """
+        Arguments:
+          cache_dir (str): The directory to store cached embeddings in.
+          model_type (str): The SAM variant the embeddings come from, e.g. 'vit_h'.
+          checkpoint (str or None): The checkpoint the model was loaded from.
+            Its path, size and modification time are part of every key, so a
+            replaced checkpoint never reuses stale embeddings.
+          max_size_bytes (int): The maximum total size of the cached files.
+            Least recently used entries are evicted beyond this size.
+          dtype (np.dtype): The dtype embeddings are stored in on disk.
+        """
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.dtype = np.dtype(dtype)
+        self.model_key = self._model_key(model_type, checkpoint)
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index = self._load_index()
+
+    @staticmethod
+    def _model_key(model_type: str, checkpoint: Optional[str]) -> str:
+        if checkpoint is None:
+            return model_type
+        stat = os.stat(checkpoint)
+        return f"{model_type}:{os.path.realpath(checkpoint)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def _load_index(self) -> "OrderedDict[str, int]":
+        """Scans the cache directory, ordering entries from least to most recently used."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npy"):
+                continue
+            key = name[: -len(".npy")]
+            if not os.path.exists(self._meta_path(key)):
+                continue
+            stat = os.stat(self._features_path(key))
+            size = stat.st_size + os.path.getsize(self._meta_path(key))
+            entries.append((stat.st_mtime_ns, key, size))
+        entries.sort()
+        return OrderedDict((key, size) for _, key, size in entries)
+
+    def _features_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def key(self, image: np.ndarray, variant: str = "") -> str:
+        """
+        Computes the cache key for an image in HWC uint8 format. variant
+        describes how the model is run, e.g. the dtype of the image encoder,
+        so that embeddings computed differently never replace each other.
+        """
+        h = hashlib.sha256()
+        h.update(self.model_key.encode("utf-8"))
+        h.update(variant.encode("utf-8"))
+        h.update(str((image.shape, image.dtype.str)).encode("utf-8"))
+        h.update(np.ascontiguousarray(image).tobytes())
+        return h.hexdigest()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def get(
+        self, key: str, device: Optional[torch.device] = None
+    ) -> Optional[Tuple[torch.Tensor, Tuple[int, ...], Tuple[int, ...]]]:
+        """
+        Loads a cached embedding.
+
+        Returns:
+          (tuple or None): None on a cache miss. Otherwise the float32 image
+            features with shape 1xCxHxW, the original image size and the
+            transformed input size, both in (H, W) format.
+        """
+        with self._lock:
+            if key not in self._index:
+                return None
+            try:
+                with open(self._meta_path(key), "r") as f:
+                    meta = json.load(f)
+                features = torch.from_numpy(np.load(self._features_path(key)).astype(np.float32))
+            except (OSError, ValueError):
+                # A partially removed or corrupt entry is treated as a miss.
+                self._remove(key)
+                return None
+            self._index.move_to_end(key)
+            os.utime(self._features_path(key))
+        return features.to(device), tuple(meta["original_size"]), tuple(meta["input_size"])
+
+    def put(
+        self,
+        key: str,
+        features: torch.Tensor,
+        original_size: Tuple[int, ...],
+        input_size: Tuple[int, ...],
+    ) -> torch.Tensor:
+        """
+        Stores an embedding, evicting least recently used entries if needed.
+
+        Returns:
+          (torch.Tensor): The features as 'get' will return them, i.e.
+            rounded to the storage dtype, on the device of the input. Using
+            these instead of the input keeps the first run of an image
+            consistent with later cached runs.
+        """
+        features_np = features.detach().to("cpu", torch.float32).numpy().astype(self.dtype)
+        meta = {"original_size": list(original_size), "input_size": list(input_size)}
+        with self._lock:
+            # Write to temporary files first so readers never see partial entries.
+            tmp_features = self._features_path(key) + ".tmp"
+            tmp_meta = self._meta_path(key) + ".tmp"
+            with open(tmp_features, "wb") as f:
+                np.save(f, features_np)
+            with open(tmp_meta, "w") as f:
+                json.dump(meta, f)
+            os.replace(tmp_meta, self._meta_path(key))
+            os.replace(tmp_features, self._features_path(key))
+
+            size = os.path.getsize(self._features_path(key)) + os.path.getsize(
+                self._meta_path(key)
+            )
+            self._index[key] = size
+            self._index.move_to_end(key)
+            self._evict()
+        return torch.from_numpy(features_np.astype(np.float32)).to(features.device)
+
+    def _evict(self) -> None:
+        total = sum(self._index.values())
+        while total > self.max_size_bytes and len(self._index) > 1:
+            key, size = next(iter(self._index.items()))
+            self._remove(key)
+            total -= size
+
+    def _remove(self, key: str) -> None:
+        self._index.pop(key, None)
+        for path in (self._features_path(key), self._meta_path(key)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def clear(self) -> None:
+        """Removes every cached embedding."""
+        with self._lock:
+            for key in list(self._index.keys()):
+                self._remove(key)
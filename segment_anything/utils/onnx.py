@@ -8,7 +8,7 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
-from typing import Tuple
+from typing import Optional, Tuple
 
 from ..modeling import Sam
 from .amg import calculate_stability_score
@@ -28,6 +28,7 @@ class SamOnnxModel(nn.Module):
         return_single_mask: bool,
         use_stability_score: bool = False,
         return_extra_metrics: bool = False,
+        crop_to_box: bool = False,
     ) -> None:
         super().__init__()
         self.mask_decoder = model.mask_decoder
@@ -37,6 +38,7 @@ class SamOnnxModel(nn.Module):
         self.use_stability_score = use_stability_score
         self.stability_score_offset = 1.0
         self.return_extra_metrics = return_extra_metrics
+        self.crop_to_box = crop_to_box
 
     @staticmethod
     def resize_longest_image_size(
@@ -89,6 +91,53 @@ class SamOnnxModel(nn.Module):
         masks = F.interpolate(masks, size=(h, w), mode="bilinear", align_corners=False)
         return masks
 
+    def mask_postprocessing_in_boxes(
+        self, masks: torch.Tensor, orig_im_size: torch.Tensor, crop_boxes: torch.Tensor
+    ) -> torch.Tensor:
+        # Computes the logits of mask_postprocessing only within each crop box.
+        # Both resizes are composed into one matrix per axis and per box, see
+        # Sam.postprocess_masks_in_regions. All crops share the size of the
+        # largest box, and pixels outside a mask's own box are set to -inf.
+        prepadded_size = self.resize_longest_image_size(orig_im_size, self.img_size)
+        orig_im_size = orig_im_size.to(torch.int64)
+        crop_boxes = crop_boxes.to(torch.int64)
+        crop_sizes = crop_boxes[:, 2:] - crop_boxes[:, :2]
+        crop_h, crop_w = crop_sizes[:, 1].max(), crop_sizes[:, 0].max()
+
+        # Upscaling to the padded input size followed by cropping the padding
+        zero = torch.zeros(1, dtype=torch.int64)
+        low_h, low_w = masks.shape[-2:]
+        rows_to_input = self._bilinear_weights(low_h, self.img_size, zero, prepadded_size[0])
+        cols_to_input = self._bilinear_weights(low_w, self.img_size, zero, prepadded_size[1])
+        rows = self._bilinear_weights(prepadded_size[0], orig_im_size[0], crop_boxes[:, 1], crop_h)
+        cols = self._bilinear_weights(prepadded_size[1], orig_im_size[1], crop_boxes[:, 0], crop_w)
+        rows = rows @ rows_to_input
+        cols = cols @ cols_to_input
+        masks = rows.unsqueeze(1) @ masks @ cols.unsqueeze(1).transpose(-1, -2)
+
+        inside_h = torch.arange(crop_h)[None, :] < crop_sizes[:, 1:2]
+        inside_w = torch.arange(crop_w)[None, :] < crop_sizes[:, 0:1]
+        inside = inside_h[:, None, :, None] & inside_w[:, None, None, :]
+        return masks.masked_fill(~inside, float("-inf"))
+
+    @staticmethod
+    def _bilinear_weights(
+        in_size: torch.Tensor, out_size: torch.Tensor, start: torch.Tensor, length: torch.Tensor
+    ) -> torch.Tensor:
+        # The weights F.interpolate applies along one axis in bilinear mode
+        # with align_corners=False, for output positions start to start +
+        # length of each box, as BxLxI one-hot blends that trace to ONNX
+        in_size = torch.as_tensor(in_size).to(torch.float32)
+        out_idx = start.reshape(-1, 1) + torch.arange(length)[None, :]
+        src = (out_idx + 0.5) * (in_size / out_size) - 0.5
+        src = src.clamp(min=0)
+        lo = torch.minimum(src.floor(), in_size - 1)
+        hi = torch.minimum(lo + 1, in_size - 1)
+        frac = (src - lo).unsqueeze(-1)
+        grid = torch.arange(in_size)
+        lo, hi = lo.unsqueeze(-1), hi.unsqueeze(-1)
+        return (lo == grid) * (1 - frac) + (hi == grid) * frac
+
     def select_masks(
         self, masks: torch.Tensor, iou_preds: torch.Tensor, num_points: int
     ) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -113,6 +162,7 @@ class SamOnnxModel(nn.Module):
         mask_input: torch.Tensor,
         has_mask_input: torch.Tensor,
         orig_im_size: torch.Tensor,
+        crop_boxes: Optional[torch.Tensor] = None,
     ):
         sparse_embedding = self._embed_points(point_coords, point_labels)
         dense_embedding = self._embed_masks(mask_input, has_mask_input)
@@ -132,13 +182,175 @@ class SamOnnxModel(nn.Module):
         if self.return_single_mask:
             masks, scores = self.select_masks(masks, scores, point_coords.shape[1])
 
-        upscaled_masks = self.mask_postprocessing(masks, orig_im_size)
+        if self.crop_to_box:
+            assert crop_boxes is not None, "crop_boxes are required with crop_to_box."
+            upscaled_masks = self.mask_postprocessing_in_boxes(masks, orig_im_size, crop_boxes)
+        else:
+            upscaled_masks = self.mask_postprocessing(masks, orig_im_size)
 
         if self.return_extra_metrics:
             stability_scores = calculate_stability_score(
                 upscaled_masks, self.model.mask_threshold, self.stability_score_offset
             )
             areas = (upscaled_masks > self.model.mask_threshold).sum(-1).sum(-1)
+
+        if self.crop_to_box:
+            upscaled_masks = (upscaled_masks > self.model.mask_threshold).to(torch.uint8)
+
+        if self.return_extra_metrics:
             return upscaled_masks, scores, stability_scores, areas, masks
 
         return upscaled_masks, scores, masks
+
+
+class SamOnnxImageEncoder(nn.Module):
+    """
+    This model should not be called directly, but is used in ONNX export.
+    It combines the pixel normalization and padding of Sam.preprocess with
+    the image encoder, so that the exported graph takes the image after
+    ResizeLongestSide, in HWC uint8 format, and returns the image embeddings.
+    """
+
+    def __init__(self, model: Sam) -> None:
+        super().__init__()
+        self.model = model
+        self.img_size = model.image_encoder.img_size
+
+    @torch.no_grad()
+    def forward(self, input_image: torch.Tensor) -> torch.Tensor:
+        x = input_image.permute(2, 0, 1).to(torch.float32)
+        x = (x - self.model.pixel_mean) / self.model.pixel_std
+        h, w = x.shape[-2:]
+        x = F.pad(x, (0, self.img_size - w, 0, self.img_size - h))
+        return self.model.image_encoder(x.unsqueeze(0))
+
+
+def export_image_encoder(model: Sam, output: str, opset: int = 17) -> None:
+    """
+    Exports the image encoder of SAM, including preprocessing, to ONNX.
+    The graph has one input 'input_image', the image after ResizeLongestSide
+    in HxWx3 uint8 format with dynamic H and W, and one output
+    'image_embeddings' of shape 1x256x64x64.
+
+    Arguments:
+      model (Sam): The model to export.
+      output (str): The path of the ONNX file to write.
+      opset (int): The ONNX opset version to use.
+    """
+    encoder = SamOnnxImageEncoder(model).eval()
+    img_size = encoder.img_size
+    dummy_input = torch.randint(
+        0, 256, (img_size, img_size * 3 // 4, 3), dtype=torch.uint8, device=model.device
+    )
+    torch.onnx.export(
+        encoder,
+        (dummy_input,),
+        output,
+        export_params=True,
+        verbose=False,
+        opset_version=opset,
+        do_constant_folding=True,
+        input_names=["input_image"],
+        output_names=["image_embeddings"],
+        dynamic_axes={"input_image": {0: "height", 1: "width"}},
+    )
+
+
+def export_mask_decoder(
+    model: Sam,
+    output: str,
+    opset: int = 17,
+    return_single_mask: bool = False,
+    use_stability_score: bool = False,
+    return_extra_metrics: bool = False,
+    batched: bool = False,
+    crop_to_box: bool = False,
+) -> None:
+    """
+    Exports the prompt encoder, mask decoder and mask postprocessing of SAM
+    to ONNX using SamOnnxModel. The number of points per prompt is dynamic.
+    With return_single_mask=False, all mask outputs of the decoder are
+    returned, as expected by SamOnnxPredictor.
+
+    With batched=True, the number of prompts is dynamic as well: point_coords
+    and point_labels are BxNx2 and BxN, mask_input is 1x1xHxW or Bx1xHxW,
+    and every output gets a leading batch axis of size B. All prompts in a
+    call share the same image and the same number of points N, e.g. one box
+    per prompt encoded as two corner points with labels 2 and 3.
+
+    With crop_to_box=True, the graph takes an extra input 'crop_boxes' with
+    one XYXY integer region per prompt, in pixels of the original image with
+    exclusive end coordinates. The output masks are then uint8, thresholded
+    at the mask threshold and computed only within these regions, as
+    BxCxHxW with (H, W) the size of the largest region. Each mask is in the
+    top-left corner, and pixels outside its own region are zero. Stability
+    scores and areas are computed within the region as well.
+
+    Arguments:
+      model (Sam): The model to export.
+      output (str): The path of the ONNX file to write.
+      opset (int): The ONNX opset version to use.
+      return_single_mask (bool): See SamOnnxModel.
+      use_stability_score (bool): See SamOnnxModel.
+      return_extra_metrics (bool): See SamOnnxModel.
+      batched (bool): Whether the number of prompts is a dynamic axis.
+      crop_to_box (bool): Whether to return thresholded masks cropped to
+        the regions given in 'crop_boxes'.
+    """
+    onnx_model = SamOnnxModel(
+        model,
+        return_single_mask=return_single_mask,
+        use_stability_score=use_stability_score,
+        return_extra_metrics=return_extra_metrics,
+        crop_to_box=crop_to_box,
+    ).eval()
+
+    embed_dim = model.prompt_encoder.embed_dim
+    embed_size = model.prompt_encoder.image_embedding_size
+    mask_input_size = [4 * x for x in embed_size]
+    # With a dynamic prompt axis the graph is traced with several prompts,
+    # so that shapes broadcast from the prompts rather than the image
+    num_prompts = 2 if batched else 1
+    dummy_inputs = {
+        "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float),
+        "point_coords": torch.randint(
+            low=0, high=1024, size=(num_prompts, 5, 2), dtype=torch.float
+        ),
+        "point_labels": torch.randint(low=0, high=4, size=(num_prompts, 5), dtype=torch.float),
+        "mask_input": torch.randn(1, 1, *mask_input_size, dtype=torch.float),
+        "has_mask_input": torch.tensor([1], dtype=torch.float),
+        "orig_im_size": torch.tensor([1500, 2250], dtype=torch.float),
+    }
+    if crop_to_box:
+        dummy_inputs["crop_boxes"] = torch.tensor(
+            [[100, 200, 700, 900], [0, 0, 300, 400]][:num_prompts], dtype=torch.float
+        )
+    if return_extra_metrics:
+        output_names = ["masks", "iou_predictions", "stability_scores", "areas", "low_res_masks"]
+    else:
+        output_names = ["masks", "iou_predictions", "low_res_masks"]
+    dynamic_axes = {
+        "point_coords": {1: "num_points"},
+        "point_labels": {1: "num_points"},
+    }
+    if batched:
+        dynamic_axes["point_coords"][0] = "num_prompts"
+        dynamic_axes["point_labels"][0] = "num_prompts"
+        dynamic_axes["mask_input"] = {0: "num_mask_inputs"}
+        if crop_to_box:
+            dynamic_axes["crop_boxes"] = {0: "num_prompts"}
+        for name in output_names:
+            dynamic_axes[name] = {0: "num_prompts"}
+
+    torch.onnx.export(
+        onnx_model,
+        tuple(x.to(model.device) for x in dummy_inputs.values()),
+        output,
+        export_params=True,
+        verbose=False,
+        opset_version=opset,
+        do_constant_folding=True,
+        input_names=list(dummy_inputs.keys()),
+        output_names=output_names,
+        dynamic_axes=dynamic_axes,
+    )
@@ -0,0 +1,215 @@
+import json
+import os
+import queue
+import threading
+
+import cv2
+from PIL import Image
+
+from model_registry import get_sam, get_yolos
+from sam.segment_objects import predict_box_masks, save_cutouts
+from segment_anything import SamPredictor
+from segment_anything.utils.embedding_cache import ImageEmbeddingCache
+from yolo.detect_fashion_items import (
+    draw_detections,
+    list_image_files,
+    load_conflict_rules,
+    load_font,
+    run_yolos,
+    select_best_detections,
+)
+
+_DONE = object()
+
+
+def run_streaming_pipeline(
+    input_path,
+    output_base_dir,
+    sam_checkpoint="sam_vit_h_4b8939.pth",
+    conflict_rules_path="yolo_conflict_rules.json",
+    min_confidence=0.5,
+    output_json_path=None,
+    save_image=False,
+    output_image_dir="output_vis",
+    embedding_cache_dir=None,
+    queue_size=4,
+    num_decode_workers=2,
+    num_write_workers=2,
+):
+    """
+    以串流方式同時執行 YOLOS 偵測與 SAM 分割：
+    讀圖 → YOLOS → SAM encode → SAM decode → 寫檔，
+    每個階段各自在執行緒中運行，階段之間以有界佇列連接，
+    總時間趨近最慢的那個階段，而不是所有階段相加。
+
+    輸出與 detect_fashion_items + segment_objects 相同，
+    中間的 sam_data JSON 只有在指定 output_json_path 時才會寫出。
+    回傳 (sam_data, results)。
+    """
+    print("🚀 初始化 YOLOS 模型中...")
+    processor, model = get_yolos()
+    print("🧠 載入 SAM 模型中...")
+    sam = get_sam("vit_h", sam_checkpoint)
+    embedding_cache = None
+    if embedding_cache_dir is not None:
+        embedding_cache = ImageEmbeddingCache(
+            embedding_cache_dir, model_type="vit_h", checkpoint=sam_checkpoint
+        )
+    # encode 與 decode 階段各用一個 predictor，共用同一個模型
+    encoder = SamPredictor(sam, embedding_cache=embedding_cache)
+    decoder = SamPredictor(sam)
+    print("✅ 模型載入完成")
+
+    font = load_font()
+    conflict_rules = load_conflict_rules(conflict_rules_path)
+    image_files = list_image_files(input_path)
+    print(f"📂 偵測到 {len(image_files)} 張圖片要處理...\n")
+
+    if save_image:
+        os.makedirs(output_image_dir, exist_ok=True)
+    os.makedirs(output_base_dir, exist_ok=True)
+
+    def decode_stage(item):
+        idx, image_path = item
+        filename = os.path.basename(image_path)
+        image = cv2.imread(image_path)
+        if image is None:
+            print(f"❌ 圖片讀取失敗：{image_path}，跳過")
+            return
+        pil_image = Image.open(image_path).convert("RGB")
+        yield idx, filename, pil_image, image
+
+    def detect_stage(item):
+        idx, filename, pil_image, image = item
+        print(f"🖼️ [{idx + 1}/{len(image_files)}] YOLOS 偵測：{filename}")
+        results = run_yolos(processor, model, [pil_image])[0]
+        best_detections = select_best_detections(
+            results, model.config.id2label, conflict_rules, min_confidence
+        )
+        records = draw_detections(pil_image, filename, best_detections, font)
+        if save_image:
+            save_path = os.path.join(output_image_dir, filename)
+            pil_image.save(save_path)
+            print(f"💾 已儲存：{save_path}")
+        if not records:
+            print(f"   ⚠️ {filename} 沒有可分割的物件，跳過 SAM")
+            return
+        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        yield idx, filename, image, image_rgb, records
+
+    def encode_stage(item):
+        embedding = encoder.encode_batch([item[3]])[0]
+        print(f"   🧠 已計算 embedding：{item[1]}")
+        yield item + (embedding,)
+
+    def mask_stage(item):
+        idx, filename, image, image_rgb, records, embedding = item
+        decoder.set_image_embedding(embedding)
+        prompts, boxes, masks, regions = predict_box_masks(decoder, records, image_rgb)
+        yield idx, filename, image, image_rgb, records, prompts, boxes, masks, regions
+
+    def write_stage(item):
+        idx, filename, image, image_rgb, records, prompts, boxes, masks, regions = item
+        saved = save_cutouts(
+            filename, records, image, image_rgb, prompts, boxes, masks, regions, output_base_dir
+        )
+        yield idx, filename, records, saved
+
+    outputs = _run_stages(
+        list(enumerate(image_files)),
+        [
+            (decode_stage, num_decode_workers),
+            (detect_stage, 1),
+            (encode_stage, 1),
+            (mask_stage, 1),
+            (write_stage, num_write_workers),
+        ],
+        queue_size,
+    )
+
+    outputs.sort(key=lambda x: x[0])
+    all_sam_data = [record for _, _, records, _ in outputs for record in records]
+    results = {filename: saved for _, filename, _, saved in outputs}
+
+    if output_json_path is not None:
+        with open(output_json_path, "w") as f:
+            json.dump(all_sam_data, f, indent=2)
+        print(f"📄 偵測資料已儲存：{output_json_path}")
+
+    print("🎉 全部圖片處理完畢！所有切割圖與原圖已輸出到：", output_base_dir)
+    return all_sam_data, results
+
+
+def _run_stages(items, stages, queue_size):
+    """
+    依序串接多個階段。stages 為 (fn, num_workers) 的列表，fn 接收一個項目並
+    yield 零個或多個輸出給下一個階段；最後一個階段的輸出會被收集後回傳。
+    任何階段拋出例外時，所有階段都會停止，並在主執行緒重新拋出該例外。
+    """
+    stop = threading.Event()
+    errors = []
+    outputs = []
+    lock = threading.Lock()
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    remaining = [num_workers for _, num_workers in stages]
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def feed():
+        for item in items:
+            put(queues[0], item)
+        for _ in range(stages[0][1]):
+            put(queues[0], _DONE)
+
+    def work(stage_idx):
+        fn, _ = stages[stage_idx]
+        is_last = stage_idx == len(stages) - 1
+        try:
+            while True:
+                item = get(queues[stage_idx])
+                if item is _DONE:
+                    break
+                for out in fn(item):
+                    if is_last:
+                        with lock:
+                            outputs.append(out)
+                    else:
+                        put(queues[stage_idx + 1], out)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            with lock:
+                remaining[stage_idx] -= 1
+                finished = remaining[stage_idx] == 0
+            # 這個階段的最後一個 worker 結束時，通知下一個階段的每個 worker
+            if finished and not is_last:
+                for _ in range(stages[stage_idx + 1][1]):
+                    put(queues[stage_idx + 1], _DONE)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for stage_idx, (_, num_workers) in enumerate(stages):
+        for _ in range(num_workers):
+            threads.append(threading.Thread(target=work, args=(stage_idx,), daemon=True))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+    return outputs
@@ -0,0 +1,34 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import pytest
+import torch
+
+from segment_anything.build_sam import _build_sam
+
+from utils import SMALL_SAM_CONFIG
+
+
+@pytest.fixture(scope="module")
+def small_sam():
+    """A small SAM with fixed random weights, standing in for a checkpoint."""
+    torch.manual_seed(0)
+    sam = _build_sam(**SMALL_SAM_CONFIG)
+    with torch.no_grad():
+        for p in sam.parameters():
+            p.normal_(0, 0.2)
+    return sam.eval()
+
+
+@pytest.fixture(scope="module")
+def image():
+    """A 480x640 RGB image with two overlapping rectangles on noise."""
+    rng = np.random.default_rng(0)
+    image = np.zeros((480, 640, 3), dtype=np.uint8)
+    image[100:300, 150:400] = 200
+    image[250:420, 350:600] = 90
+    return np.clip(image + rng.integers(0, 30, image.shape), 0, 255).astype(np.uint8)
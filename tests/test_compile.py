@@ -0,0 +1,62 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import copy
+
+import numpy as np
+import pytest
+import torch
+
+from segment_anything import SamPredictor
+
+
+def _failing_compile(fn, **kwargs):
+    def compiled(*args, **kwargs):
+        raise RuntimeError("backend failure")
+
+    return compiled
+
+
+def _predict(sam, image):
+    predictor = SamPredictor(sam)
+    predictor.set_image(image)
+    return predictor.predict(box=np.array([140, 90, 410, 310]), multimask_output=False)
+
+
+def test_failed_compilation_falls_back_to_eager(monkeypatch, small_sam, image):
+    sam = copy.deepcopy(small_sam)
+    suppress_errors = torch._dynamo.config.suppress_errors
+    monkeypatch.setattr(torch, "compile", _failing_compile)
+    sam.compile_for_inference()
+    assert sam.image_encoder._compiled_call_impl is not None
+    assert sam.mask_decoder._compiled_call_impl is not None
+
+    with pytest.warns(UserWarning, match="running it eagerly"):
+        masks, scores, _ = _predict(sam, image)
+    expected_masks, expected_scores, _ = _predict(small_sam, image)
+    np.testing.assert_array_equal(masks, expected_masks)
+    np.testing.assert_allclose(scores, expected_scores)
+    assert sam.image_encoder._compiled_call_impl is None
+    assert sam.mask_decoder._compiled_call_impl is None
+    assert torch._dynamo.config.suppress_errors == suppress_errors
+
+
+def test_eager_errors_are_raised(monkeypatch, small_sam):
+    sam = copy.deepcopy(small_sam)
+    monkeypatch.setattr(torch, "compile", _failing_compile)
+    sam.compile_for_inference()
+    with pytest.raises(RuntimeError):
+        sam.image_encoder(torch.zeros(1, 4, 1024, 1024))
+    assert sam.image_encoder._compiled_call_impl is not None
+
+
+def test_compiled_modules_are_not_compiled_again(monkeypatch, small_sam):
+    sam = copy.deepcopy(small_sam)
+    sam.compile_for_inference()
+    compiled_call = sam.image_encoder._compiled_call_impl
+    monkeypatch.setattr(torch, "compile", _failing_compile)
+    sam.compile_for_inference()
+    assert sam.image_encoder._compiled_call_impl is compiled_call
@@ -0,0 +1,55 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+import torch
+
+from segment_anything.modeling.image_encoder import Attention, add_decomposed_rel_pos
+
+
+def _reference_attention(attn, x):
+    """The unfused attention, with the relative position bias added to the full map."""
+    B, H, W, _ = x.shape
+    qkv = attn.qkv(x).reshape(B, H * W, 3, attn.num_heads, -1).permute(2, 0, 3, 1, 4)
+    q, k, v = qkv.reshape(3, B * attn.num_heads, H * W, -1).unbind(0)
+
+    scores = (q * attn.scale) @ k.transpose(-2, -1)
+    if attn.use_rel_pos:
+        scores = add_decomposed_rel_pos(scores, q, attn.rel_pos_h, attn.rel_pos_w, (H, W), (H, W))
+    out = scores.softmax(dim=-1) @ v
+    out = out.view(B, attn.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+    return attn.proj(out)
+
+
+# Query rows per chunk: one, three with a shorter last chunk since H is not a
+# multiple of 3, and all rows in one chunk with the default limit
+@pytest.mark.parametrize("rows", [1, 3, None], ids=["row-chunks", "uneven-chunks", "one-chunk"])
+@pytest.mark.parametrize("size", [(14, 14), (16, 11)], ids=["windowed", "global"])
+def test_fused_rel_pos_attention_matches_reference(size, rows):
+    torch.manual_seed(0)
+    H, W = size
+    attn = Attention(dim=32, num_heads=4, use_rel_pos=True, input_size=size)
+    with torch.no_grad():
+        attn.rel_pos_h.normal_()
+        attn.rel_pos_w.normal_()
+    if rows is not None:
+        attn.max_bias_elements = rows * W * H * W
+    x = torch.randn(2, H, W, 32)
+
+    with torch.no_grad():
+        out = attn(x)
+        expected = _reference_attention(attn, x)
+    assert out.shape == x.shape
+    torch.testing.assert_close(out, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_fused_attention_without_rel_pos_matches_reference():
+    torch.manual_seed(0)
+    attn = Attention(dim=32, num_heads=4, use_rel_pos=False)
+    x = torch.randn(2, 14, 14, 32)
+
+    with torch.no_grad():
+        torch.testing.assert_close(attn(x), _reference_attention(attn, x), rtol=1e-5, atol=1e-5)
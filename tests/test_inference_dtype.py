@@ -0,0 +1,91 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import copy
+
+import numpy as np
+import pytest
+import torch
+
+from segment_anything import SamPredictor
+from segment_anything.build_sam import _build_sam, _quantize_sam
+from segment_anything.utils.embedding_cache import ImageEmbeddingCache
+
+from utils import SMALL_SAM_CONFIG, mask_iou
+
+
+BOXES = np.array([[140, 90, 410, 310], [340, 240, 610, 430], [100, 50, 620, 450]])
+
+
+def _masks(sam, image):
+    predictor = SamPredictor(sam)
+    predictor.set_image(image)
+    return [predictor.predict(box=box, multimask_output=False)[0][0] for box in BOXES]
+
+
+def _bfloat16_encoder(sam):
+    sam.set_inference_dtype(torch.bfloat16)
+
+
+def _bfloat16(sam):
+    sam.set_inference_dtype(torch.bfloat16, torch.bfloat16)
+
+
+@pytest.mark.parametrize(
+    "convert, min_iou",
+    [(_bfloat16_encoder, 0.95), (_bfloat16, 0.95), (_quantize_sam, 0.9)],
+    ids=["bf16-encoder", "bf16", "int8"],
+)
+def test_reduced_precision_masks_match_float32(small_sam, image, convert, min_iou):
+    reference = _masks(small_sam, image)
+
+    low = copy.deepcopy(small_sam)
+    convert(low)
+    for ref, mask in zip(reference, _masks(low, image)):
+        assert ref.any()
+        assert mask_iou(ref, mask) > min_iou
+
+
+def test_int8_checkpoint_round_trip(tmp_path, small_sam, image):
+    quantized = copy.deepcopy(small_sam)
+    _quantize_sam(quantized)
+    checkpoint = str(tmp_path / "sam_int8.pth")
+    torch.save(quantized.state_dict(), checkpoint)
+
+    with pytest.raises(ValueError):
+        _build_sam(**SMALL_SAM_CONFIG, checkpoint=checkpoint)
+    loaded = _build_sam(**SMALL_SAM_CONFIG, checkpoint=checkpoint, quantize="int8")
+    assert loaded.encoder_quantized
+    for expected, mask in zip(_masks(quantized, image), _masks(loaded, image)):
+        np.testing.assert_array_equal(mask, expected)
+
+
+def test_cache_keeps_encoder_dtypes_apart(tmp_path, small_sam, image):
+    sam = small_sam
+    low = copy.deepcopy(sam)
+    low.set_inference_dtype(torch.bfloat16)
+    cache = ImageEmbeddingCache(str(tmp_path), model_type="test")
+
+    reference = SamPredictor(sam, embedding_cache=cache)
+    reference.set_image(image)
+    predictor = SamPredictor(low, embedding_cache=cache)
+    predictor.set_image(image)
+    assert not torch.equal(reference.features, predictor.features)
+    assert sam.encoder_dtype == torch.float32
+
+
+def test_cache_keeps_int8_and_float32_apart(tmp_path, small_sam, image):
+    sam = small_sam
+    quantized = copy.deepcopy(sam)
+    _quantize_sam(quantized)
+    cache = ImageEmbeddingCache(str(tmp_path), model_type="test")
+
+    reference = SamPredictor(sam, embedding_cache=cache)
+    reference.set_image(image)
+    predictor = SamPredictor(quantized, embedding_cache=cache)
+    predictor.set_image(image)
+    assert quantized.encoder_quantized and not sam.encoder_quantized
+    assert not torch.equal(reference.features, predictor.features)
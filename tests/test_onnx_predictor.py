@@ -0,0 +1,119 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import pytest
+
+from segment_anything import SamPredictor
+from segment_anything.utils.onnx import export_image_encoder, export_mask_decoder
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from segment_anything.onnx_predictor import SamOnnxPredictor  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def onnx_dir(tmp_path_factory, small_sam):
+    tmp_path = tmp_path_factory.mktemp("onnx")
+    export_image_encoder(small_sam, str(tmp_path / "encoder.onnx"))
+    return tmp_path
+
+
+DECODER_VARIANTS = [
+    {},
+    {"batched": True},
+    {"crop_to_box": True},
+    {"crop_to_box": True, "batched": True},
+]
+
+
+@pytest.fixture(
+    scope="module",
+    params=DECODER_VARIANTS,
+    ids=["default", "batched", "crop_to_box", "crop_to_box-batched"],
+)
+def predictors(request, onnx_dir, small_sam, image):
+    decoder_path = str(onnx_dir / f"decoder_{request.param_index}.onnx")
+    export_mask_decoder(small_sam, decoder_path, **request.param)
+
+    predictor = SamPredictor(small_sam)
+    predictor.set_image(image)
+    onnx_predictor = SamOnnxPredictor(str(onnx_dir / "encoder.onnx"), decoder_path)
+    onnx_predictor.set_image(image)
+    assert onnx_predictor.batched == request.param.get("batched", False)
+    assert onnx_predictor.crop_to_box == request.param.get("crop_to_box", False)
+    return predictor, onnx_predictor
+
+
+def test_embeddings_match(predictors):
+    predictor, onnx_predictor = predictors
+    expected = predictor.get_image_embedding().numpy()
+    np.testing.assert_allclose(onnx_predictor.get_image_embedding(), expected, atol=1e-4)
+
+
+@pytest.mark.parametrize(
+    "prompt",
+    [
+        {"point_coords": np.array([[260, 200]]), "point_labels": np.array([1])},
+        {
+            "point_coords": np.array([[260, 200], [470, 330]]),
+            "point_labels": np.array([1, 0]),
+        },
+        {"box": np.array([140, 90, 410, 310])},
+        {
+            "point_coords": np.array([[470, 330]]),
+            "point_labels": np.array([1]),
+            "box": np.array([340, 240, 610, 430]),
+        },
+    ],
+)
+@pytest.mark.parametrize("multimask_output", [True, False])
+def test_predictions_match(predictors, prompt, multimask_output):
+    predictor, onnx_predictor = predictors
+    _, scores, low_res = predictor.predict(**prompt, multimask_output=multimask_output)
+    _, onnx_scores, onnx_low_res = onnx_predictor.predict(
+        **prompt, multimask_output=multimask_output
+    )
+    assert onnx_low_res.shape == low_res.shape
+    np.testing.assert_allclose(onnx_low_res, low_res, atol=1e-3)
+    np.testing.assert_allclose(onnx_scores, scores, atol=1e-4)
+
+
+BOXES = np.array([[140, 90, 410, 310], [340, 240, 610, 430], [100, 50, 620, 450]])
+
+
+@pytest.mark.parametrize("multimask_output", [True, False])
+def test_box_batch_matches_single_boxes(predictors, multimask_output):
+    predictor, onnx_predictor = predictors
+    masks, scores, _ = onnx_predictor.predict_boxes(BOXES, multimask_output=multimask_output)
+    assert masks.shape[:2] == scores.shape == (len(BOXES), 3 if multimask_output else 1)
+    for box, box_masks, box_scores in zip(BOXES, masks, scores):
+        expected_masks, expected_scores, _ = predictor.predict(
+            box=box, multimask_output=multimask_output
+        )
+        assert (box_masks == expected_masks).mean() >= 0.99
+        np.testing.assert_allclose(box_scores, expected_scores, atol=1e-4)
+
+
+@pytest.mark.parametrize("margin", [0, 25])
+@pytest.mark.parametrize("multimask_output", [True, False])
+def test_box_crops_match(predictors, margin, multimask_output):
+    predictor, onnx_predictor = predictors
+    # The last box reaches past the image border
+    boxes = np.concatenate([BOXES, [[500, 300, 660, 500]]])
+    masks, scores, regions = onnx_predictor.predict_box_crops(
+        boxes, margin=margin, multimask_output=multimask_output
+    )
+    expected_masks, expected_scores, expected_regions = predictor.predict_box_crops(
+        boxes, margin=margin, multimask_output=multimask_output
+    )
+    np.testing.assert_array_equal(regions, expected_regions)
+    np.testing.assert_allclose(scores, expected_scores, atol=1e-4)
+    for mask, expected in zip(masks, expected_masks):
+        assert mask.dtype == bool
+        assert mask.shape == expected.shape
+        assert (mask == expected).mean() >= 0.99
@@ -0,0 +1,36 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pytest
+import torch
+
+from segment_anything.utils.transforms import ResizeLongestSide
+
+
+def _regions(h, w):
+    return [
+        (w // 4, h // 3, w // 2 + 7, h // 2 + 5),  # interior
+        (0, 0, w // 3, h // 5),  # top-left corner
+        (w - w // 5, h - 11, w, h),  # bottom-right corner
+        (0, h // 2, w, h // 2 + 1),  # one row across the image
+        (0, 0, w, h),  # the whole image
+    ]
+
+
+@pytest.mark.parametrize("original_size", [(481, 643), (1001, 333), (700, 700)])
+def test_region_upsampling_matches_full_upsampling(small_sam, original_size):
+    torch.manual_seed(0)
+    h, w = original_size
+    input_size = ResizeLongestSide.get_preprocess_shape(h, w, small_sam.image_encoder.img_size)
+    regions = _regions(h, w)
+    masks = torch.randn(len(regions), 3, 256, 256) * 10
+
+    full = small_sam.postprocess_masks(masks, input_size, original_size)
+    crops = small_sam.postprocess_masks_in_regions(masks, input_size, original_size, regions)
+    assert len(crops) == len(regions)
+    for mask, crop, (x0, y0, x1, y1) in zip(full, crops, regions):
+        assert crop.shape == (3, y1 - y0, x1 - x0)
+        torch.testing.assert_close(crop, mask[:, y0:y1, x0:x1], rtol=0, atol=1e-4)
@@ -0,0 +1,73 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import copy
+import glob
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from segment_anything import SamPredictor, sam_model_registry
+from segment_anything.utils.embedding_cache import ImageEmbeddingCache
+
+from utils import mask_iou
+
+
+def test_cache_keeps_padding_modes_apart(tmp_path, small_sam, image):
+    cache = ImageEmbeddingCache(str(tmp_path), model_type="test")
+    padded = SamPredictor(small_sam, embedding_cache=cache)
+    padded.set_image(image)
+    skipped = SamPredictor(small_sam, embedding_cache=cache, skip_padding=True)
+    skipped.set_image(image)
+    assert not torch.equal(padded.features, skipped.features)
+
+    reference = SamPredictor(small_sam, skip_padding=True)
+    reference.set_image(image)
+    torch.testing.assert_close(skipped.features, reference.features, rtol=0, atol=1e-2)
+
+
+def test_skip_padding_rejects_compiled_encoder(small_sam, image):
+    with pytest.raises(ValueError):
+        SamPredictor(copy.deepcopy(small_sam), compile=True, skip_padding=True)
+
+    sam = copy.deepcopy(small_sam)
+    predictor = SamPredictor(sam, skip_padding=True)
+    sam.compile_for_inference()
+    with pytest.raises(ValueError):
+        predictor.set_image(image)
+
+
+@pytest.mark.skipif(
+    "SAM_CHECKPOINT" not in os.environ,
+    reason="Set SAM_CHECKPOINT (and SAM_MODEL_TYPE, default vit_b) to run.",
+)
+def test_skip_padding_matches_padded_masks_with_checkpoint():
+    Image = pytest.importorskip("PIL.Image")
+    image_dir = os.path.join(os.path.dirname(__file__), "..", "become_image")
+    paths = sorted(glob.glob(os.path.join(image_dir, "*", "*.png")))
+    if not paths:
+        pytest.skip("No test images found.")
+    model_type = os.environ.get("SAM_MODEL_TYPE", "vit_b")
+    sam = sam_model_registry[model_type](checkpoint=os.environ["SAM_CHECKPOINT"])
+    padded = SamPredictor(sam)
+    skipped = SamPredictor(sam, skip_padding=True)
+
+    ious = []
+    for path in paths[:4]:
+        image = np.array(Image.open(path).convert("RGB"))
+        padded.set_image(image)
+        skipped.set_image(image)
+        h, w = image.shape[:2]
+        for y in np.linspace(0.2, 0.8, 3) * h:
+            for x in np.linspace(0.2, 0.8, 3) * w:
+                prompt = {"point_coords": np.array([[x, y]]), "point_labels": np.array([1])}
+                masks, _, _ = padded.predict(**prompt, multimask_output=False)
+                skipped_masks, _, _ = skipped.predict(**prompt, multimask_output=False)
+                ious.append(mask_iou(masks[0], skipped_masks[0]))
+    assert np.mean(ious) > 0.9
+    assert np.min(ious) > 0.5
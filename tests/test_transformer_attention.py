@@ -0,0 +1,40 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import math
+
+import pytest
+import torch
+
+from segment_anything.modeling.transformer import Attention
+
+
+def _reference_attention(attn, q, k, v):
+    """The unfused q @ k^T -> softmax -> @ v computation."""
+    q = attn._separate_heads(attn.q_proj(q), attn.num_heads)
+    k = attn._separate_heads(attn.k_proj(k), attn.num_heads)
+    v = attn._separate_heads(attn.v_proj(v), attn.num_heads)
+    scores = q @ k.permute(0, 1, 3, 2) / math.sqrt(q.shape[-1])
+    out = torch.softmax(scores, dim=-1) @ v
+    return attn.out_proj(attn._recombine_heads(out))
+
+
+@pytest.mark.parametrize("downsample_rate", [1, 2])
+@pytest.mark.parametrize("q_batch, kv_batch", [(3, 3), (3, 1)])
+def test_fused_attention_matches_reference(downsample_rate, q_batch, kv_batch):
+    torch.manual_seed(0)
+    attn = Attention(embedding_dim=64, num_heads=8, downsample_rate=downsample_rate)
+    # Token-to-image shapes: a few prompt tokens attend to an image grid,
+    # which is shared by all prompts when kv_batch is 1
+    q = torch.randn(q_batch, 7, 64)
+    k = torch.randn(kv_batch, 256, 64)
+    v = torch.randn(kv_batch, 256, 64)
+
+    with torch.no_grad():
+        out = attn(q, k, v)
+        expected = _reference_attention(attn, q, k, v)
+    assert out.shape == (q_batch, 7, 64)
+    torch.testing.assert_close(out, expected, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,18 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# The architecture of the small model used in place of a checkpoint
+SMALL_SAM_CONFIG = dict(
+    encoder_embed_dim=64,
+    encoder_depth=2,
+    encoder_num_heads=2,
+    encoder_global_attn_indexes=[1],
+)
+
+
+def mask_iou(a, b):
+    """The intersection over union of two boolean masks, 0 if both are empty."""
+    return (a & b).sum() / max((a | b).sum(), 1)
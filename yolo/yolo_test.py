@@ -1,14 +1,13 @@
 from PIL import Image, ImageDraw, ImageFont
 import torch
-from transformers import AutoImageProcessor, AutoModelForObjectDetection
+from model_registry import get_yolos
 
 def visualize_yolos_detections(image_path, target_label=None, min_confidence=0.5, show=True):
     # 讀取圖片
     image = Image.open(image_path).convert("RGB")
 
-    # 載入模型
-    processor = AutoImageProcessor.from_pretrained("valentinafeve/yolos-fashionpedia")
-    model = AutoModelForObjectDetection.from_pretrained("valentinafeve/yolos-fashionpedia")
+    # 載入模型（同一個 process 只會載入一次）
+    processor, model = get_yolos()
 
     # 推論
     inputs = processor(images=image, return_tensors="pt")